@@ -1,16 +1,118 @@
-import json
+import hashlib
+import os
+import orjson
 import boto3
+from botocore.config import Config
 import time
 import random
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-bedrock = boto3.client("bedrock-runtime", region_name="us-east-1")
+# Large pool for concurrent segment calls; retries are owned by invoke_with_backoff
+BOTO_CONFIG = Config(
+    max_pool_connections=50,
+    retries={"mode": "standard", "max_attempts": 1},
+    tcp_keepalive=True
+)
 
-def invoke_with_backoff(payload, max_retries=5):
+bedrock = boto3.client("bedrock-runtime", region_name="us-east-1", config=BOTO_CONFIG)
+
+# Markdown code fence (```json ... ```) wrapped around Claude's JSON answer
+CODE_FENCE_PATTERN = re.compile(r'^\s*```(?:json)?\s*(.*?)\s*(?:```)?\s*$', re.DOTALL)
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+MAX_OUTPUT_TOKENS = 4000
+
+# Constant parts of the Messages API request body, encoded once; only the prompt varies
+REQUEST_BODY_HEAD = (
+    b'{"anthropic_version":"bedrock-2023-05-31","max_tokens":%d,"temperature":0.5,' % MAX_OUTPUT_TOKENS
+    + b'"messages":[{"role":"user","content":'
+)
+REQUEST_BODY_TAIL = b'}]}'
+
+def build_request_body(prompt):
+    return REQUEST_BODY_HEAD + orjson.dumps(prompt) + REQUEST_BODY_TAIL
+
+# Upper bound on concurrent Bedrock invocations per Lambda run
+MAX_CONCURRENT_SEGMENTS = 8
+
+# Bedrock on-demand token quota for the model (tokens per minute); quotas vary by account, region and model
+BEDROCK_TOKENS_PER_MINUTE = int(os.environ.get("BEDROCK_TOKENS_PER_MINUTE", "200000"))
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter that blocks before a request would exceed the quota.
+
+    Args:
+        rate_per_sec: Tokens added back to the bucket per second
+        burst: Maximum number of tokens the bucket can hold
+    """
+    def __init__(self, rate_per_sec, burst):
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, cost=1):
+        cost = min(cost, self.burst)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate_per_sec)
+                self.last_refill = now
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return
+                wait = (cost - self.tokens) / self.rate_per_sec
+            time.sleep(wait)
+
+# Module global so the bucket state survives across warm invocations
+token_bucket = TokenBucket(BEDROCK_TOKENS_PER_MINUTE / 60.0, BEDROCK_TOKENS_PER_MINUTE)
+
+def est_tokens(prompt):
+    # Bedrock reserves max_tokens against the quota up front, on top of the input tokens
+    return len(prompt) // 4 + MAX_OUTPUT_TOKENS
+
+# In-process cache of Claude evaluations, reused across warm invocations
+EVAL_CACHE_TTL_SECONDS = 3600
+EVAL_CACHE_MAX_ENTRIES = 256
+
+_eval_cache = {}
+_eval_cache_lock = threading.Lock()
+
+def eval_cache_key(segment, fields):
+    # Canonical JSON so semantically equal field lists hash equal
+    canonical_fields = orjson.dumps(fields, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(segment.encode("utf-8") + b"|" + canonical_fields).hexdigest()
+
+def get_cached_evaluation(key):
+    with _eval_cache_lock:
+        entry = _eval_cache.get(key)
+        if entry is None:
+            return None
+        expires_at, evaluations = entry
+        if expires_at < time.monotonic():
+            del _eval_cache[key]
+            return None
+        return evaluations
+
+def put_cached_evaluation(key, evaluations):
+    with _eval_cache_lock:
+        if key not in _eval_cache and len(_eval_cache) >= EVAL_CACHE_MAX_ENTRIES:
+            # Evict the oldest entry (dicts keep insertion order)
+            _eval_cache.pop(next(iter(_eval_cache)))
+        _eval_cache[key] = (time.monotonic() + EVAL_CACHE_TTL_SECONDS, evaluations)
+
+def invoke_with_backoff(payload, token_cost=0, max_retries=5):
     for attempt in range(max_retries):
+        token_bucket.acquire(cost=token_cost)
         try:
             response = bedrock.invoke_model(**payload)
             return response
         except bedrock.exceptions.ThrottlingException as e:
+            # Only reached when the quota drifts from BEDROCK_TOKENS_PER_MINUTE
             wait = 2 ** attempt + random.uniform(0, 1)
             print(f"Throttled. Retrying in {wait:.2f} seconds...")
             time.sleep(wait)
@@ -19,10 +121,8 @@ def invoke_with_backoff(payload, max_retries=5):
             raise e
     raise Exception("Max retries exceeded due to throttling.")
 
-def lambda_handler(event, context):
-    segment = event.get("segment")
+def evaluate_segment(segment, fields):
     print("segment:", segment)
-    fields = event.get("fields", [])
     print("fields:", fields)
 
     if not segment or not fields:
@@ -31,6 +131,16 @@ def lambda_handler(event, context):
             "error": "Missing 'segment' or 'fields' in request payload."
         }
 
+    cache_key = eval_cache_key(segment, fields)
+    cached = get_cached_evaluation(cache_key)
+    if cached is not None:
+        print(f"Cache hit for segment {segment}")
+        return {
+            "statusCode": 200,
+            "segment": segment,
+            "evaluations": cached
+        }
+
     prompt = f"""
     You are an HL7 transformation assistant. Your task is to evaluate HL7 field values from the {segment} segment against transformation rules and produce a clean, structured JSON response.
 
@@ -40,7 +150,7 @@ def lambda_handler(event, context):
     - Ruleset (if any)
 
     Fields:
-    {json.dumps(fields, indent=2)}
+    {orjson.dumps(fields, option=orjson.OPT_INDENT_2).decode()}
 
     **Instructions:**
 
@@ -110,33 +220,27 @@ def lambda_handler(event, context):
 
 
     payload = {
-        "modelId": "anthropic.claude-3-sonnet-20240229-v1:0",
+        "modelId": MODEL_ID,
         "contentType": "application/json",
         "accept": "application/json",
-        "body": json.dumps({
-            "anthropic_version": "bedrock-2023-05-31",
-            "messages": [{"role": "user", "content": prompt}],
-            "max_tokens": 4000,
-            "temperature": 0.5
-        })
+        "body": build_request_body(prompt)
     }
 
     try:
-        response = invoke_with_backoff(payload)
-        result = json.loads(response["body"].read())
+        response = invoke_with_backoff(payload, token_cost=est_tokens(prompt))
+        result = orjson.loads(response["body"].read())
         claude_text = result["content"][0]["text"]
         print("claude_text:", claude_text)
 
         
         try:
             # Remove Markdown code block if present
-            if claude_text.strip().startswith("```json"):
-                claude_text = claude_text.strip().removeprefix("```json").removesuffix("```").strip()
-            elif claude_text.strip().startswith("```"):
-                claude_text = claude_text.strip().removeprefix("```").removesuffix("```").strip()
+            fence = CODE_FENCE_PATTERN.match(claude_text)
+            claude_text = fence.group(1) if fence else claude_text.strip()
 
-            parsed = json.loads(claude_text)
-        except json.JSONDecodeError:
+            parsed = orjson.loads(claude_text)
+            put_cached_evaluation(cache_key, parsed)
+        except orjson.JSONDecodeError:
             parsed = {
                 "error": "Claude response could not be parsed as JSON",
                 "raw_response": claude_text
@@ -153,3 +257,29 @@ def lambda_handler(event, context):
             "statusCode": 500,
             "error": str(e)
         }
+
+def lambda_handler(event, context):
+    segments = event.get("segments")
+
+    # Single-segment payload (one invocation per segment)
+    if segments is None:
+        return evaluate_segment(event.get("segment"), event.get("fields", []))
+
+    if not segments:
+        return []
+
+    # Evaluate all segments in one Lambda run, overlapping the Bedrock round-trips
+    with ThreadPoolExecutor(max_workers=min(len(segments), MAX_CONCURRENT_SEGMENTS)) as executor:
+        results = list(executor.map(
+            lambda seg: evaluate_segment(seg.get("segment"), seg.get("fields", [])),
+            segments
+        ))
+
+    return [
+        {
+            "segment": seg.get("segment"),
+            "fields": seg.get("fields", []),
+            "evaluation_result": result
+        }
+        for seg, result in zip(segments, results)
+    ]
@@ -1,132 +1,112 @@
+import io
 import json
+import os
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
 import boto3
+from botocore.config import Config
 import re
+from concurrent.futures import ThreadPoolExecutor
 
-s3 = boto3.client("s3")
+# Larger connection pool with keep-alive, reused across warm invocations
+BOTO_CONFIG = Config(
+    max_pool_connections=50,
+    retries={"mode": "standard"},
+    tcp_keepalive=True
+)
+
+s3 = boto3.client("s3", config=BOTO_CONFIG)
 bucket_name = "hl7v2autoct"
 template_key = "config/mirth_templates/mirth_orm_template.xml"
+# Template stays in the standard bucket; OUTPUT_BUCKET can point at an S3 Express One Zone directory bucket
+output_bucket_name = os.environ.get("OUTPUT_BUCKET", bucket_name)
 output_key_prefix = "output/mirth_js_xml_code/"
 output_key = f"{output_key_prefix}mirth_js_xml_code.xml"
 
+# Precomputed indentation strings (two spaces per level)
+INDENTS = tuple('  ' * i for i in range(64))
+
+def get_indent(level):
+    return INDENTS[level] if level < len(INDENTS) else '  ' * level
+
+# Everything between the START marker line and the END marker line of the template
+JS_BLOCK_PATTERN = re.compile(
+    r'(// START_JAVASCRIPT_CODE[^\n]*)\n.*?([^\n]*// END_JAVASCRIPT_CODE)',
+    re.DOTALL
+)
+
 def prettify_xml(elem):
     """Return a pretty-printed XML string for the Element without XML declaration."""
-    rough_string = ET.tostring(elem, encoding='unicode')
-    reparsed = minidom.parseString(rough_string)
-    pretty_xml = reparsed.toprettyxml(indent="  ")
-    # Remove XML declaration line
-    return '\n'.join(pretty_xml.split('\n')[1:])
-
-def extract_javascript_from_template(template_content):
-    """Extract JavaScript code between START and END markers."""
-    lines = template_content.split('\n')
-    js_lines = []
-    capture = False
-    
-    for line in lines:
-        if '// START_JAVASCRIPT_CODE' in line:
-            capture = True
-            continue
-        elif '// END_JAVASCRIPT_CODE' in line:
-            capture = False
-            continue
-        
-        if capture:
-            js_lines.append(line)
-    
-    return '\n'.join(js_lines)
+    # Indents in place; tostring with encoding='unicode' emits no XML declaration
+    ET.indent(elem, space="  ")
+    return ET.tostring(elem, encoding='unicode')
 
 def replace_javascript_in_template(template_content, new_js_code):
-    """Replace JavaScript code between START and END markers with new code."""
-    lines = template_content.split('\n')
-    result_lines = []
-    capture = False
-    
-    for line in lines:
-        if '// START_JAVASCRIPT_CODE' in line:
-            result_lines.append(line)
-            result_lines.append(new_js_code)
-            capture = True
-            continue
-        elif '// END_JAVASCRIPT_CODE' in line:
-            result_lines.append(line)
-            capture = False
-            continue
-        
-        if not capture:
-            result_lines.append(line)
-    
-    return '\n'.join(result_lines)
+    """Replace JavaScript code between every pair of START and END markers with new code."""
+    # Function replacement so backslashes in the JS are not treated as group references
+    return JS_BLOCK_PATTERN.sub(
+        lambda m: f"{m.group(1)}\n{new_js_code}\n{m.group(2)}",
+        template_content
+    )
 
 def indent_js_code(js_code):
     """
     Properly indent JavaScript code based on braces and control structures.
     """
-    lines = js_code.split('\n')
-    indented_lines = []
+    buf = io.StringIO()
     indent_level = 0
     base_indent = 1  # Base indentation for code inside try block
+    first = True
     
-    for line in lines:
-        stripped = line.strip()
+    for line in js_code.split('\n'):
+        if first:
+            first = False
+        else:
+            buf.write('\n')
         
-        # Skip empty lines (will be added back without indent)
+        # Empty lines are written back without indent
+        if not line:
+            continue
+        stripped = line.strip()
         if not stripped:
-            indented_lines.append('')
             continue
         
-        # Skip comment lines (add base indent + current level)
+        # Comment lines get base indent + current level
         if stripped.startswith('//'):
-            indented_lines.append('  ' * (base_indent + indent_level) + stripped)
+            buf.write(get_indent(base_indent + indent_level))
+            buf.write(stripped.replace("'", "&apos;"))
             continue
         
         # Decrease indent for closing braces
         if stripped.startswith('}'):
             indent_level = max(0, indent_level - 1)
         
-        # Add the line with proper indentation (base + current level)
-        indented_lines.append('  ' * (base_indent + indent_level) + stripped)
+        # Write the line with proper indentation, escaping single quotes for XML
+        buf.write(get_indent(base_indent + indent_level))
+        buf.write(stripped.replace("'", "&apos;"))
         
         # Increase indent for opening braces
         if stripped.endswith('{'):
             indent_level += 1
     
-    # Join lines and replace single quotes with XML entity
-    result = '\n'.join(indented_lines)
-    result = result.replace("'", "&apos;")
-    
-    return result
+    return buf.getvalue()
 
-def lambda_handler(event, context):
-    print("event:", event)
-    js_specs = event.get("js_specs", [])
-    print("js_specs:", js_specs)
-    
-    # Read the template file from S3
-    try:
-        template_response = s3.get_object(Bucket=bucket_name, Key=template_key)
-        template_content = template_response['Body'].read().decode('utf-8')
-        print("Template file loaded successfully")
-    except Exception as e:
-        print(f"Error reading template file: {str(e)}")
-        return {
-            "status": "error",
-            "message": f"Failed to read template: {str(e)}"
-        }
-    
+def load_template():
+    """Read the Mirth channel template from S3."""
+    template_response = s3.get_object(Bucket=bucket_name, Key=template_key)
+    return template_response['Body'].read().decode('utf-8')
+
+def build_js_code(js_specs):
+    """Assemble and indent the combined JavaScript for all segments."""
     js_content = []
     current_segment = None
 
+    # js_specs is the flat [{"segment", "fields"}] list returned by generate_mirth_js_code
     for spec in js_specs:
         print("spec:", spec)
-        js_result = spec.get("js_result", [])
-        print("js_result:", js_result)
-        if not js_result:
+        segment = spec.get("segment", "")
+        fields = spec.get("fields", [])
+        if not fields:
             continue
-
-        segment = js_result[0].get("segment", "")
-        fields = js_result[0].get("fields", [])
         print("fields:", fields)
         
         # Add segment comment header
@@ -163,9 +143,30 @@ def lambda_handler(event, context):
     raw_js_code = "\n".join(js_content)
     
     # Apply proper indentation
-    new_js_code = indent_js_code(raw_js_code)
+    return indent_js_code(raw_js_code)
+
+def lambda_handler(event, context):
+    print("event:", event)
+    js_specs = event.get("js_specs", [])
+    print("js_specs:", js_specs)
     
-    print("Generated JavaScript:\n", new_js_code)
+    # Download the template in the background while the JavaScript is assembled
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        template_future = executor.submit(load_template)
+
+        new_js_code = build_js_code(js_specs)
+        print("Generated JavaScript:\n", new_js_code)
+
+        # Read the template file from S3
+        try:
+            template_content = template_future.result()
+            print("Template file loaded successfully")
+        except Exception as e:
+            print(f"Error reading template file: {str(e)}")
+            return {
+                "status": "error",
+                "message": f"Failed to read template: {str(e)}"
+            }
 
     # Replace JavaScript in template
     updated_template = replace_javascript_in_template(template_content, new_js_code)
@@ -173,7 +174,7 @@ def lambda_handler(event, context):
 
     # Save the updated template to S3
     s3.put_object(
-        Bucket=bucket_name,
+        Bucket=output_bucket_name,
         Key=output_key,
         Body=updated_template,
         ContentType="application/xml"
@@ -181,6 +182,6 @@ def lambda_handler(event, context):
 
     return {
         "status": "combined XML saved",
-        "s3_path": f"s3://{bucket_name}/{output_key}",
+        "s3_path": f"s3://{output_bucket_name}/{output_key}",
         "template_used": f"s3://{bucket_name}/{template_key}"
     }
\ No newline at end of file
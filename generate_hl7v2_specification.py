@@ -1,42 +1,84 @@
-import json
+import orjson
 import boto3
+from botocore.config import Config
 import io
+import os
 from datetime import datetime
-from collections import defaultdict
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, PatternFill, Alignment
 
 # Initialize S3 client
-s3 = boto3.client("s3")
+# Larger connection pool with keep-alive, reused across warm invocations
+BOTO_CONFIG = Config(
+    max_pool_connections=50,
+    retries={"mode": "standard"},
+    tcp_keepalive=True
+)
 
-# S3 target
-bucket_name = "hl7v2autoct"
+s3 = boto3.client("s3", config=BOTO_CONFIG)
+
+# S3 target (OUTPUT_BUCKET can point at an S3 Express One Zone directory bucket)
+bucket_name = os.environ.get("OUTPUT_BUCKET", "hl7v2autoct")
 output_prefix = "output/hl7v2_specifications"
 
+# Read-only default for fields without a Claude evaluation
+EMPTY_EVALUATION = {}
+
+# Flattened form of each raw string value seen in the current invocation
+_flatten_memo = {}
+
+# Shared cell styles
+HEADER_FONT = Font(bold=True, color="FFFFFF")
+HEADER_FILL = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+HEADER_ALIGN = Alignment(horizontal="center", vertical="center", wrap_text=True)
+
+# Specification sheet layout
+SPEC_HEADERS = (
+    "Data Element", "Canonical Field", "Source Field", "Usage",
+    "Fill Rate", "Min Length", "Max Length", "Transformation Rules",
+    "Sample Input Values", "Expected Output"
+)
+
+SPEC_WIDTHS = (
+    ('A', 30),  # Data Element
+    ('B', 18),  # Canonical Field
+    ('C', 18),  # Source Field
+    ('D', 12),  # Usage
+    ('E', 12),  # Fill Rate
+    ('F', 12),  # Min Length
+    ('G', 12),  # Max Length
+    ('H', 60),  # Transformation Rules (increased width)
+    ('I', 50),  # Sample Input Values
+    ('J', 50)   # Expected Output
+)
+
 def upload_to_s3(specs):
     # timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
     # filename = f"specs_{timestamp}.xlsx"
     filename = "HL7v2_ORM_Specification.xlsx"
     s3_key = f"{output_prefix}/{filename}"
 
-    # Create Excel workbook
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Specifications"
+    # Create Excel workbook (write-only: rows are streamed, not kept as Cell objects)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Specifications")
 
-    # Define headers
-    headers = [
-        "Data Element", "Canonical Field", "Source Field", "Usage",
-        "Fill Rate", "Min Length", "Max Length", "Transformation Rules",
-        "Sample Input Values", "Expected Output"
-    ]
-    ws.append(headers)
+    # Set column widths
+    for col, width in SPEC_WIDTHS:
+        ws.column_dimensions[col].width = width
+
+    # Freeze header row
+    ws.freeze_panes = 'A2'
 
     # Format header row
-    for cell in ws[1]:
-        cell.font = Font(bold=True, color="FFFFFF")
-        cell.fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-        cell.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
+    header_cells = []
+    for header in SPEC_HEADERS:
+        cell = WriteOnlyCell(ws, value=header)
+        cell.font = HEADER_FONT
+        cell.fill = HEADER_FILL
+        cell.alignment = HEADER_ALIGN
+        header_cells.append(cell)
+    ws.append(header_cells)
 
     # Populate rows
     for spec in specs:
@@ -53,8 +95,6 @@ def upload_to_s3(specs):
         else:
             trans_rules = str(trans_rules) if trans_rules else ""
 
-        print("trans_rules:", trans_rules)
-        
         row = [
             spec.get("Data Element", ""),
             spec.get("Canonical Field", ""),
@@ -69,127 +109,119 @@ def upload_to_s3(specs):
         ]
         ws.append(row)
 
-    # Set column widths
-    column_widths = {
-        'A': 30,  # Data Element
-        'B': 18,  # Canonical Field
-        'C': 18,  # Source Field
-        'D': 12,  # Usage
-        'E': 12,  # Fill Rate
-        'F': 12,  # Min Length
-        'G': 12,  # Max Length
-        'H': 60,  # Transformation Rules (increased width)
-        'I': 50,  # Sample Input Values
-        'J': 50   # Expected Output
-    }
-    
-    for col, width in column_widths.items():
-        ws.column_dimensions[col].width = width
-
-    # Freeze header row
-    ws.freeze_panes = 'A2'
-
     # Save to memory
     file_stream = io.BytesIO()
     wb.save(file_stream)
     file_stream.seek(0)
 
-    # Upload to S3
-    s3.put_object(
-        Bucket=bucket_name,
-        Key=s3_key,
-        Body=file_stream.getvalue(),
-        ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    # Upload to S3 (streamed from the buffer, no bytes copy)
+    s3.upload_fileobj(
+        file_stream,
+        bucket_name,
+        s3_key,
+        ExtraArgs={"ContentType": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"}
     )
 
     return f"s3://{bucket_name}/{s3_key}", s3_key
 
+def decode_value(value):
+    """
+    Decode a value that arrives as a JSON-encoded HL7 array string (e.g. Athena output).
+    Anything else is returned unchanged.
+    """
+    if isinstance(value, str):
+        stripped = value.strip()
+        if stripped.startswith('[') and stripped.endswith(']'):
+            try:
+                return orjson.loads(value)
+            except Exception:
+                return value  # Keep as-is if parsing fails
+    return value
+
 def flatten_value(value):
     """
-    Flatten a single value according to HL7v2 encoding rules:
+    Flatten a single, already-decoded value according to HL7v2 encoding rules:
     - Nested lists (components & subcomponents): use ^ for components, & for subcomponents
     - Simple lists: join with ^
     - Primitives: convert to string
     """
-    print(f"Flattening value: {value}")
-    print(f"Type of value: {type(value)}")
-    
-    # If it's a string that looks like JSON, try to parse it first
-    if isinstance(value, str):
-        # Check if it looks like a JSON array
-        if value.strip().startswith('[') and value.strip().endswith(']'):
-            try:
-                value = json.loads(value)
-                print(f"Parsed string to: {value}")
-            except Exception as e:
-                print(f"Failed to parse JSON string: {e}")
-                return value  # Return as-is if parsing fails
+    if not isinstance(value, list):
+        return str(value)
+
+    parts = []
+    for item in value:
+        if isinstance(item, list):
+            # Subcomponents (a triple-nested list is joined with & as well)
+            parts.append("&".join(
+                "&".join(map(str, sub)) if isinstance(sub, list) else str(sub)
+                for sub in item
+            ))
         else:
-            print(f"Value is not a list: {value}")
-            return value  # Return plain string as-is
-    
-    if isinstance(value, list):
-        print(f"Value is a list with {len(value)} items")
-        parts = []
-        for item in value:
-            if isinstance(item, list):
-                # Recursively handle nested lists - this handles subcomponents
-                subparts = []
-                for subitem in item:
-                    if isinstance(subitem, list):
-                        # Triple nested - join with & first
-                        subsubcomp = "&".join(str(s) if s != "" else "" for s in subitem)
-                        print(f"    Triple-nested subcomponent: {subsubcomp}")
-                        subparts.append(subsubcomp)
-                    else:
-                        # Regular subcomponent
-                        subparts.append(str(subitem) if subitem != "" else "")
-                subcomp = "&".join(subparts)
-                print(f"  Subcomponent: {subcomp}")
-                parts.append(subcomp)
-            else:
-                # Component - convert to string
-                comp = str(item) if item != "" else ""
-                print(f"  Component: {comp}")
-                parts.append(comp)
-        result = "^".join(parts)
-        print(f"Flattened result: {result}")
-        return result
-    
-    print(f"Returning as string: {value}")
-    return str(value) if value != "" else ""
+            parts.append(str(item))
+    return "^".join(parts)
 
 def format_value_list(value_list):
     """
     Format a list of values (repetitions) for display.
-    Each value is flattened, then joined with comma-space for readability.
+    Each value is decoded and flattened, then joined with comma-space for readability.
     """
-    print(f"Formatting value list: {value_list}")
-    
     if not isinstance(value_list, (list, tuple)):
         value_list = [value_list] if value_list is not None else []
     
     formatted_values = []
     for v in value_list:
-        flattened = flatten_value(v)
+        if isinstance(v, str):
+            # Repeated values (e.g. the same code array across fields) are decoded and flattened once
+            flattened = _flatten_memo.get(v)
+            if flattened is None:
+                flattened = flatten_value(decode_value(v))
+                _flatten_memo[v] = flattened
+        else:
+            flattened = flatten_value(decode_value(v))
         if flattened:  # Only add non-empty values
             formatted_values.append(flattened)
     
-    result = ", ".join(formatted_values)
-    print(f"Final formatted result: {result}")
-    return result
+    return ", ".join(formatted_values)
+
+def parse_sample_values(sample_values_raw):
+    """
+    Parse the Athena sample_values JSON array into a list of sample values.
+    Non-list JSON is wrapped in a list; unparseable input is kept as a single raw value.
+    """
+    if not sample_values_raw:
+        return []
+    try:
+        parsed_values = orjson.loads(sample_values_raw)
+    except Exception:
+        return [sample_values_raw]
+    if isinstance(parsed_values, (list, tuple)):
+        return parsed_values
+    return [parsed_values]
 
 def lambda_handler(event, context):
     evaluations = event.get("evaluations", [])
-    print("Received evaluations:", json.dumps(evaluations))
+    _flatten_memo.clear()  # Keep the memo scoped to this request
+    print("Received evaluations:", orjson.dumps(evaluations).decode())
 
     all_specs = []
-    grouped_specs = defaultdict(list)
+    grouped_specs = []  # [{"segment": ..., "fields": [...]}] in first-seen order
+    segment_groups = {}
 
     for segment_obj in evaluations:
         segment = segment_obj.get("segment")
         fields = segment_obj.get("fields", [])
+        if not fields:
+            continue
+
+        # Rows for a segment are appended straight into its output group
+        group = segment_groups.get(segment)
+        if group is None:
+            group = {"segment": segment, "fields": []}
+            segment_groups[segment] = group
+            grouped_specs.append(group)
+        group_rows = group["fields"]
         field_evals = segment_obj.get("evaluation_result", {})
+        evaluations_map = (field_evals or {}).get("evaluations") or {}
 
         for field in fields:
             field_id = field.get("field_id")
@@ -197,22 +229,12 @@ def lambda_handler(event, context):
             usage = field.get("usage")
             stats = field.get("stats", {})
 
-            sample_values_raw = stats.get("all_values")
-            sample_values = []
-            if sample_values_raw:
-                try:
-                    parsed_values = json.loads(sample_values_raw)
-                    if isinstance(parsed_values, (list, tuple)):
-                        sample_values = parsed_values
-                    else:
-                        sample_values = [parsed_values]
-                except Exception:
-                    sample_values = [sample_values_raw]
+            sample_values = parse_sample_values(stats.get("sample_values"))
 
             fill_rate = stats.get("fill_rate")
             has_stats = bool(stats) and fill_rate not in [None, "0", 0, "0.0", 0.0]
 
-            field_eval = field_evals.get("evaluations", {}).get(field_id, {})
+            field_eval = evaluations_map.get(field_id) or EMPTY_EVALUATION
             rule_triggered = field_eval.get("Rule Triggered", "No")
             transformation = field_eval.get("Transformation Rules", "")
             expected_output_raw = field_eval.get("Expected Output", "")
@@ -223,19 +245,13 @@ def lambda_handler(event, context):
                 field_id
             )
 
-            expected_output_list = expected_output_raw if isinstance(expected_output_raw, list) else sample_values
-
-            if not isinstance(expected_output_list, (list, tuple)):
-                expected_output_list = [expected_output_list] if expected_output_list is not None else []
-
-            # Format the outputs - flatten_value now handles string parsing
-            print("--- Formatting Expected Output ---")
-            formatted_expected_output = format_value_list(expected_output_list)
-            print(f"Formatted Expected Output: {formatted_expected_output}")
-            
-            print("--- Formatting Sample Values ---")
+            # Format the outputs - format_value_list decodes JSON-encoded values
             formatted_sample_values = format_value_list(sample_values)
-            print(f"Formatted Sample Values: {formatted_sample_values}")
+            if isinstance(expected_output_raw, list):
+                formatted_expected_output = format_value_list(expected_output_raw)
+            else:
+                # Expected output falls back to the sample values, already formatted above
+                formatted_expected_output = formatted_sample_values
 
             spec_row = {
                 "Data Element": label,
@@ -251,7 +267,7 @@ def lambda_handler(event, context):
             }
 
             all_specs.append(spec_row)
-            grouped_specs[segment].append(spec_row)
+            group_rows.append(spec_row)
 
     s3_path, s3_key = upload_to_s3(all_specs)
 
@@ -268,13 +284,7 @@ def lambda_handler(event, context):
 
     return {
         "statusCode": 200,
-        "specs": [
-            {
-                "segment": segment,
-                "fields": fields
-            }
-            for segment, fields in grouped_specs.items()
-        ],
+        "specs": grouped_specs,
         "s3_path": s3_path,
         "download_url": download_url
     }
\ No newline at end of file
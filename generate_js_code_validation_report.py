@@ -1,14 +1,57 @@
 import json
+import orjson
 import boto3
+from botocore.config import Config
 import io
+import os
 import logging
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, PatternFill, Alignment
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3 = boto3.client("s3")
+# Larger connection pool with keep-alive, reused across warm invocations
+BOTO_CONFIG = Config(
+    max_pool_connections=50,
+    retries={"mode": "standard"},
+    tcp_keepalive=True
+)
+
+s3 = boto3.client("s3", config=BOTO_CONFIG)
+
+# Shared cell styles
+HEADER_FONT = Font(bold=True, color="FFFFFF")
+HEADER_FILL = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+HEADER_ALIGN = Alignment(horizontal="center", vertical="center", wrap_text=True)
+WRAP_ALIGN = Alignment(wrap_text=True, vertical="top")
+PASS_FILL = PatternFill(start_color="C6EFCE", end_color="C6EFCE", fill_type="solid")
+PASS_FONT = Font(color="006100")
+FAIL_FILL = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")
+FAIL_FONT = Font(color="9C0006")
+
+# Validation report sheet layout
+REPORT_HEADERS = (
+    "Segment", "Data Element", "Canonical Field", "Source Field", 
+    "Transformation Rules", "Source Field JS Code", "Sample Input", 
+    "Expected Output", "Actual Output", "Validation Status", 
+    "Validation Comments"
+)
+
+REPORT_WIDTHS = (
+    ('A', 12),  # Segment
+    ('B', 30),  # Data Element
+    ('C', 15),  # Canonical Field
+    ('D', 15),  # Source Field
+    ('E', 50),  # Transformation Rules
+    ('F', 60),  # Source Field JS Code
+    ('G', 40),  # Sample Input
+    ('H', 40),  # Expected Output
+    ('I', 40),  # Actual Output
+    ('J', 18),  # Validation Status
+    ('K', 50)   # Validation Comments
+)
 
 def lambda_handler(event, context):
     logger.info(f"Received event keys: {list(event.keys())}")
@@ -22,7 +65,7 @@ def lambda_handler(event, context):
         body = validation_data["body"]
         logger.info(f"Found body, type: {type(body)}")
         if isinstance(body, str):
-            body = json.loads(body)
+            body = orjson.loads(body)
         validation_report = body.get("validation_report", [])
     else:
         validation_report = validation_data.get("validation_report", [])
@@ -33,29 +76,31 @@ def lambda_handler(event, context):
     total_fields = sum(len(seg.get("fields", [])) for seg in validation_report)
     logger.info(f"Total fields to export: {total_fields}")
     
-    bucket = "hl7v2autoct"
+    # OUTPUT_BUCKET can point at an S3 Express One Zone directory bucket
+    bucket = os.environ.get("OUTPUT_BUCKET", "hl7v2autoct")
     prefix = "output/final_js_validation/"
     filename = "JS_Code_Validation_Report.xlsx"
 
-    # Create Excel workbook
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Validation Report"
-
-    # Define column headers
-    headers = [
-        "Segment", "Data Element", "Canonical Field", "Source Field", 
-        "Transformation Rules", "Source Field JS Code", "Sample Input", 
-        "Expected Output", "Actual Output", "Validation Status", 
-        "Validation Comments"
-    ]
-    ws.append(headers)
+    # Create Excel workbook (write-only: rows are streamed, not kept as Cell objects)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Validation Report")
+
+    # Set column widths
+    for col, width in REPORT_WIDTHS:
+        ws.column_dimensions[col].width = width
     
+    # Freeze header row
+    ws.freeze_panes = 'A2'
+
     # Format header row
-    for cell in ws[1]:
-        cell.font = Font(bold=True, color="FFFFFF")
-        cell.fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-        cell.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
+    header_cells = []
+    for header in REPORT_HEADERS:
+        cell = WriteOnlyCell(ws, value=header)
+        cell.font = HEADER_FONT
+        cell.fill = HEADER_FILL
+        cell.alignment = HEADER_ALIGN
+        header_cells.append(cell)
+    ws.append(header_cells)
 
     # Populate rows - UPDATED: Single row per field
     row_count = 0
@@ -65,7 +110,8 @@ def lambda_handler(event, context):
         logger.info(f"Processing segment {segment_name} with {len(fields)} fields")
         
         for field in fields:
-            logger.info(f"Transformation Rules for {field.get('Canonical Field')}: {field.get('Transformation Rules')}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Transformation Rules for %s: %s", field.get("Canonical Field"), field.get("Transformation Rules"))
             # UPDATED: Each field creates exactly ONE row (no loops over sample values)
             raw_row = [
                 segment_name,
@@ -83,60 +129,41 @@ def lambda_handler(event, context):
 
             # Convert any list values to comma-separated strings
             safe_row = [", ".join(v) if isinstance(v, list) else v for v in raw_row]
-            ws.append(safe_row)
 
-            row_count += 1
-            
-            # Apply conditional formatting to Validation Status
-            status_cell = ws.cell(row=ws.max_row, column=10)  # Column J (Validation Status)
+            # Wrap text in every data cell
+            row_cells = []
+            for value in safe_row:
+                cell = WriteOnlyCell(ws, value=value)
+                cell.alignment = WRAP_ALIGN
+                row_cells.append(cell)
+
+            # Apply conditional formatting to Validation Status (column J)
+            status_cell = row_cells[9]
             status = field.get("Validation Status", "")
             
             if status == "Pass":
-                status_cell.fill = PatternFill(start_color="C6EFCE", end_color="C6EFCE", fill_type="solid")
-                status_cell.font = Font(color="006100")
+                status_cell.fill = PASS_FILL
+                status_cell.font = PASS_FONT
             elif status == "Fail":
-                status_cell.fill = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")
-                status_cell.font = Font(color="9C0006")
+                status_cell.fill = FAIL_FILL
+                status_cell.font = FAIL_FONT
 
-    logger.info(f"Total rows written: {row_count}")
+            ws.append(row_cells)
+            row_count += 1
 
-    # Set column widths
-    column_widths = {
-        'A': 12,  # Segment
-        'B': 30,  # Data Element
-        'C': 15,  # Canonical Field
-        'D': 15,  # Source Field
-        'E': 50,  # Transformation Rules
-        'F': 60,  # Source Field JS Code
-        'G': 40,  # Sample Input
-        'H': 40,  # Expected Output
-        'I': 40,  # Actual Output
-        'J': 18,  # Validation Status
-        'K': 50   # Validation Comments
-    }
-    
-    for col, width in column_widths.items():
-        ws.column_dimensions[col].width = width
-    
-    # Freeze header row
-    ws.freeze_panes = 'A2'
-    
-    # Enable text wrapping for all data cells
-    for row in ws.iter_rows(min_row=2, max_row=ws.max_row):
-        for cell in row:
-            cell.alignment = Alignment(wrap_text=True, vertical="top")
+    logger.info(f"Total rows written: {row_count}")
 
     # Save to memory
     file_stream = io.BytesIO()
     wb.save(file_stream)
     file_stream.seek(0)
 
-    # Upload to S3
-    s3.put_object(
-        Bucket=bucket,
-        Key=prefix + filename,
-        Body=file_stream.getvalue(),
-        ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    # Upload to S3 (streamed from the buffer, no bytes copy)
+    s3.upload_fileobj(
+        file_stream,
+        bucket,
+        prefix + filename,
+        ExtraArgs={"ContentType": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"}
     )
     
     # Generate pre-signed URL (valid for 1 hour)
@@ -1,9 +1,86 @@
+import hashlib
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+import io
 import json
+import os
 import time
 import random
-
-bedrock = boto3.client("bedrock-runtime", region_name="us-east-1")
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+# Adaptive retries let botocore rate-limit throttled calls before invoke_with_backoff sees them.
+# The pool covers the concurrent segment workers; request shapes are fixed, so client-side validation is skipped.
+BOTO_CONFIG = Config(
+    retries={"mode": "adaptive", "max_attempts": 10},
+    max_pool_connections=64,
+    parameter_validation=False,
+    tcp_keepalive=True
+)
+
+# One session per container, shared by all clients
+_SESSION = boto3.Session()
+bedrock = _SESSION.client("bedrock-runtime", region_name="us-east-1", config=BOTO_CONFIG)
+s3 = _SESSION.client("s3", config=BOTO_CONFIG)
+
+# Generated JS is cached per segment so re-runs on an unchanged ruleset skip Bedrock
+cache_bucket_name = os.environ.get("CACHE_BUCKET", "hl7v2autoct")
+CACHE_PREFIX = "cache/mirth_js_code/"
+
+# Upper bound on concurrent Bedrock invocations per Lambda run
+MAX_CONCURRENT_SEGMENTS = 8
+# Full-jitter backoff parameters (seconds) for throttled Bedrock calls
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30
+THROTTLING_ERROR_CODES = ("ThrottlingException", "TooManyRequestsException")
+# Output budget per call: an envelope per Claude-generated field, capped at the model's output limit.
+# Bedrock reserves max_tokens against the TPM quota up front, so a flat 4000 starves concurrent calls.
+MAX_OUTPUT_TOKENS = 4096
+# Only fields with real transformation rules reach Claude, each emitting its logic twice plus the canonical reference
+OUTPUT_TOKENS_PER_FIELD = 300
+OUTPUT_TOKENS_BASE = 200
+# Small segments are packed into one Claude call up to this many fields, so a full pack keeps its per-field budget
+MAX_FIELDS_PER_CALL = (MAX_OUTPUT_TOKENS - OUTPUT_TOKENS_BASE) // OUTPUT_TOKENS_PER_FIELD
+
+# Cross-region inference profile IDs ("us." prefix); newer models cannot be invoked on-demand by bare model ID
+MODEL_ID = os.environ.get("BEDROCK_MODEL_ID", "us.anthropic.claude-haiku-4-5-20251001-v1:0")
+# Used with standard latency if the primary model/settings are rejected
+FALLBACK_MODEL_ID = os.environ.get("BEDROCK_FALLBACK_MODEL_ID", "us.anthropic.claude-3-sonnet-20240229-v1:0")
+# Latency-optimized inference is only offered for some models/regions, so it is opt-in
+PERFORMANCE_LATENCY = os.environ.get("BEDROCK_PERFORMANCE_LATENCY", "standard")
+
+# (model_id, performance latency, cache system prompt) request settings, tried in order.
+# A rejected latency setting is retried on the primary model with standard latency before swapping models.
+REQUEST_VARIANTS = [(MODEL_ID, PERFORMANCE_LATENCY, True)]
+if PERFORMANCE_LATENCY != "standard":
+    REQUEST_VARIANTS.append((MODEL_ID, "standard", True))
+REQUEST_VARIANTS.append((FALLBACK_MODEL_ID, "standard", False))
+# Models whose cached JS may be served, in the order call_claude tries them
+CACHE_MODEL_IDS = list(dict.fromkeys(model_id for model_id, _, _ in REQUEST_VARIANTS))
+# ValidationException messages meaning the model, inference profile or latency setting is unavailable.
+# Any other ValidationException (input too long, bad max_tokens, malformed messages) is a request error.
+UNSUPPORTED_SETTINGS_PATTERN = re.compile(
+    r"model identifier is invalid|on-demand throughput|inference profile|latency|performanceConfig|cache_control"
+    r"|(?:isn't|is not|not) supported|(?:doesn't|does not) support",
+    re.IGNORECASE
+)
+
+# Field headers split Claude's response into one chunk per field, so a missing block cannot borrow the next field's code
+FIELD_HEADER_PATTERN = re.compile(r"=== SEGMENT:\s*([^/\n]+?)\s*/\s*FIELD:\s*([^=\n]+?)\s*===")
+# One match per code block within a field chunk; code bodies are captured without surrounding whitespace
+CODE_BLOCK_PATTERN = re.compile(
+    r"\*\* Start (Canonical|Source|Canonical-Source) Code \*\*\s*(.*?)\s*\*\* End \1 Code \*\*",
+    re.DOTALL
+)
+CODE_BLOCK_KEYS = {
+    "Canonical": "Canonical Field JS Code",
+    "Source": "Source Field JS Code",
+    "Canonical-Source": "Canonical-Source Field JS Code"
+}
+
+# HL7 field reference such as PID-5 or PID-5.7 (segment, field, optional component)
+FIELD_REF_PATTERN = re.compile(r"^([A-Z][A-Z0-9]{2})-(\d+)(?:\.(\d+))?$")
 
 def get_canonical_js_code(field_id):
     segment, path = field_id.split("-")
@@ -12,8 +89,45 @@ def get_canonical_js_code(field_id):
     sub = parts[1] if len(parts) > 1 else "1"
     return f"tmp['{segment}']['{segment}.{field}']['{segment}.{field}.{sub}']"
 
-def build_claude_prompt(segment, fields):
-    prompt = f"""You are an expert in HL7 v2, JavaScript, and Mirth Connect. Your task is to generate JavaScript logic for HL7 fields using Mirth Connect conventions.
+def format_field_ref(root, field_ref):
+    """Render a field reference as root['SEG']['SEG.X']['SEG.X.Y'], or None if it is not a plain field reference."""
+    match = FIELD_REF_PATTERN.match(field_ref.strip())
+    if not match:
+        return None
+    segment, field, component = match.groups()
+    component = component or "1"
+    return f"{root}['{segment}']['{segment}.{field}']['{segment}.{field}.{component}']"
+
+def synthesize_js(field):
+    """
+    Generate the three JS blocks locally for fields whose code is fully determined by the
+    rules in SYSTEM_PROMPT: NA/empty sources and direct mappings without transformation rules.
+    Returns None when the field needs Claude.
+    """
+    canonical = format_field_ref("tmp", field["Canonical Field"])
+    if canonical is None:
+        return None
+
+    source = field.get("Source Field", "")
+    if not source or source in ["NA", "N/A"]:
+        return {
+            "Canonical Field JS Code": f"{canonical};",
+            "Source Field JS Code": '""',
+            "Canonical-Source Field JS Code": f'{canonical} = "";'
+        }
+
+    if field.get("Transformation Rules"):
+        return None
+    source_ref = format_field_ref("msg", source)
+    if source_ref is None:
+        return None
+    return {
+        "Canonical Field JS Code": f"{canonical};",
+        "Source Field JS Code": f"{source_ref}.toString()",
+        "Canonical-Source Field JS Code": f"{canonical} = {source_ref}.toString();"
+    }
+
+SYSTEM_PROMPT = """You are an expert in HL7 v2, JavaScript, and Mirth Connect. Your task is to generate JavaScript logic for HL7 fields using Mirth Connect conventions.
 
 Template Reference:
 tmp['SEG']['SEG.X']['SEG.X.Y'] = msg['SEG']['SEG.A']['SEG.A.B'].toString();
@@ -61,16 +175,16 @@ WHEN TRANSFORMATION RULES ARE PROVIDED:
 - Example:
 let tmpPID5 = '';
 const pid5Values = msg['PID']['PID.5'];
-for (let i = 0; i < pid5Values.length; i++) {{
+for (let i = 0; i < pid5Values.length; i++) {
     const pid5Iteration = pid5Values[i];
     const pid5_7 = pid5Iteration['PID.5.7'].toString();
-    if (pid5_7 === 'L' || pid5_7 === 'Current' || pid5_7 === 'Legal') {{
+    if (pid5_7 === 'L' || pid5_7 === 'Current' || pid5_7 === 'Legal') {
         tmpPID5 = pid5Iteration['PID.5.1'].toString();
         break;
-    }} else if (tmpPID5 === '') {{
+    } else if (tmpPID5 === '') {
         tmpPID5 = pid5Iteration['PID.5.1'].toString();
-    }}
-}}
+    }
+}
 
 WHEN NO TRANSFORMATION RULES ARE PROVIDED:
 - Return ONLY the msg reference with .toString()
@@ -93,16 +207,16 @@ WHEN TRANSFORMATION RULES ARE PROVIDED:
 - Example:
 let tmpPID5 = '';
 const pid5Values = msg['PID']['PID.5'];
-for (let i = 0; i < pid5Values.length; i++) {{
+for (let i = 0; i < pid5Values.length; i++) {
     const pid5Iteration = pid5Values[i];
     const pid5_7 = pid5Iteration['PID.5.7'].toString();
-    if (pid5_7 === 'L' || pid5_7 === 'Current' || pid5_7 === 'Legal') {{
+    if (pid5_7 === 'L' || pid5_7 === 'Current' || pid5_7 === 'Legal') {
         tmpPID5 = pid5Iteration['PID.5.1'].toString();
         break;
-    }} else if (tmpPID5 === '') {{
+    } else if (tmpPID5 === '') {
         tmpPID5 = pid5Iteration['PID.5.1'].toString();
-    }}
-}}
+    }
+}
 tmp['PID']['PID.5']['PID.5.1'] = tmpPID5;
 
 WHEN NO TRANSFORMATION RULES ARE PROVIDED (direct mapping):
@@ -132,10 +246,11 @@ CRITICAL: YOU MUST GENERATE SEPARATE CODE BLOCKS FOR EACH FIELD
 - Do NOT combine multiple fields into one block
 - Always maintain the exact block structure for every field
 - Process fields one at a time in the order provided
+- Fields may belong to different segments; always echo each field's Segment in its header
 
 Output Format (REPEAT THIS STRUCTURE FOR EVERY FIELD):
 
-=== FIELD: <Canonical Field ID> ===
+=== SEGMENT: <Segment> / FIELD: <Canonical Field ID> ===
 
 *** Canonical Field JS Code: ***
 ** Start Canonical Code **
@@ -153,35 +268,71 @@ Output Format (REPEAT THIS STRUCTURE FOR EVERY FIELD):
 ** End Canonical-Source Code **
 
 Input Format I Will Provide:
+Segment: HL7 segment the field belongs to (e.g., PID)
 Canonical Field: Target field location (e.g., PID-5)
 Source Field: Source field location (e.g., PID-5) - may be "NA" or empty if field not present in source
 Transformation Rule: Logic description (e.g., "If PID-5.7 is 'L', 'Current', or 'Legal', copy that iteration. Otherwise, copy first non-null iteration.")
+"""
 
-Segment: {segment}
+FIELDS_PROMPT_HEADER = "FIELDS TO PROCESS:\n"
 
-FIELDS TO PROCESS:
-"""
+# Part of every JS cache key, so editing the instructions invalidates JS generated under the old prompt
+PROMPT_VERSION = hashlib.sha256((SYSTEM_PROMPT + FIELDS_PROMPT_HEADER).encode("utf-8")).hexdigest()
 
-    for i, field in enumerate(fields, 1):
-        canonical = field["Canonical Field"]
-        source = field.get("Source Field", "")
-        rule = field.get("Transformation Rules", "")
-        
-        # Make it explicit when source is NA or empty
-        source_display = source if source and source not in ["NA", "N/A"] else "NA (field not present in source)"
-        
-        prompt += f"\n\nField #{i}:\n- Canonical Field: {canonical}\n- Source Field: {source_display}\n- Transformation Rule: {rule if rule else '(No transformation - direct mapping)'}\n"
-    
-    return prompt
+def pack_segments(segment_list, max_fields=MAX_FIELDS_PER_CALL):
+    """
+    Greedily group consecutive segments so each group holds at most max_fields fields.
+    A segment larger than max_fields gets a group of its own.
+    """
+    groups = []
+    current = []
+    current_fields = 0
+
+    for segment_obj in segment_list:
+        field_count = len(segment_obj["fields"])
+        if current and current_fields + field_count > max_fields:
+            groups.append(current)
+            current = []
+            current_fields = 0
+        current.append(segment_obj)
+        current_fields += field_count
+
+    if current:
+        groups.append(current)
+    return groups
+
+def build_claude_prompt(segment_group):
+    """Build the per-call user message; the static instructions live in SYSTEM_PROMPT."""
+    parts = [FIELDS_PROMPT_HEADER]
+
+    i = 0
+    for segment_obj in segment_group:
+        segment = segment_obj["segment"]
+        for field in segment_obj["fields"]:
+            i += 1
+            canonical = field["Canonical Field"]
+            source = field.get("Source Field", "")
+            rule = field.get("Transformation Rules", "")
+
+            # Make it explicit when source is NA or empty
+            source_display = source if source and source not in ["NA", "N/A"] else "NA (field not present in source)"
+
+            parts.append(f"\n\nField #{i}:\n- Segment: {segment}\n- Canonical Field: {canonical}\n- Source Field: {source_display}\n- Transformation Rule: {rule if rule else '(No transformation - direct mapping)'}\n")
+
+    return "".join(parts)
 
 
 def invoke_with_backoff(payload, max_retries=8):
     for attempt in range(max_retries):
         try:
-            response = bedrock.invoke_model(**payload)
+            response = bedrock.invoke_model_with_response_stream(**payload)
             return response
-        except bedrock.exceptions.ThrottlingException:
-            wait = 2 ** attempt + random.uniform(0, 2)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in THROTTLING_ERROR_CODES:
+                print(f"Non-throttling error: {str(e)}")
+                raise e
+            # Full jitter keeps concurrent Lambdas from retrying in lockstep
+            wait = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
             print(f"Throttled. Retrying in {wait:.2f} seconds...")
             time.sleep(wait)
         except Exception as e:
@@ -189,105 +340,214 @@ def invoke_with_backoff(payload, max_retries=8):
             raise e
     raise Exception("Max retries exceeded due to throttling.")
 
-def call_claude(prompt):
-    payload = {
-        "modelId": "anthropic.claude-3-sonnet-20240229-v1:0",
-        "contentType": "application/json",
-        "accept": "application/json",
-        "body": json.dumps({
-            "anthropic_version": "bedrock-2023-05-31",
-            "messages": [{"role": "user", "content": prompt}],
-            "max_tokens": 4000,
-            "temperature": 0.2
-        })
-    }
-
-    response = invoke_with_backoff(payload)
-    
-    result = json.loads(response["body"].read())
-    return result["content"][0]["text"].strip()
-
-def parse_claude_response(response_text, fields):
-    print("@@@@@@@@@@@@@@@Claude raw response:\n", response_text)
-    
-    field_map = {}
-    
-    # Split response by field markers
-    field_sections = response_text.split("=== FIELD:")
-    
-    for section in field_sections[1:]:  # Skip the first empty split
-        lines = section.split("\n")
-        field_id = lines[0].strip().replace("===", "").strip()
-        
-        canonical_code = ""
-        source_code = ""
-        combined_code = ""
-        
-        mode = None
-        inside_block = False
-        current_block = []
-        
-        for line in lines[1:]:
-            line_stripped = line.strip()
-            
-            if line_stripped == "** Start Canonical Code **":
-                mode = "canonical"
-                inside_block = True
-                current_block = []
-                continue
-            elif line_stripped == "** End Canonical Code **":
-                canonical_code = "\n".join(current_block).strip()
-                inside_block = False
-                continue
-            elif line_stripped == "** Start Source Code **":
-                mode = "source"
-                inside_block = True
-                current_block = []
-                continue
-            elif line_stripped == "** End Source Code **":
-                source_code = "\n".join(current_block).strip()
-                inside_block = False
-                continue
-            elif line_stripped == "** Start Canonical-Source Code **":
-                mode = "combined"
-                inside_block = True
-                current_block = []
-                continue
-            elif line_stripped == "** End Canonical-Source Code **":
-                combined_code = "\n".join(current_block).strip()
-                inside_block = False
-                continue
-            
-            if inside_block:
-                current_block.append(line)
-        
-        field_map[field_id] = {
-            "Canonical Field JS Code": canonical_code,
-            "Source Field JS Code": source_code,
-            "Canonical-Source Field JS Code": combined_code
+def read_stream_text(response):
+    """Return (text, stop_reason) from the events of an InvokeModelWithResponseStream response."""
+    text = io.StringIO()
+    stop_reason = None
+    for event in response["body"]:
+        chunk = event.get("chunk")
+        if chunk is None:
+            # Error events (e.g. modelStreamErrorException) arrive in place of a chunk
+            raise Exception(f"Bedrock stream error: {event}")
+        data = json.loads(chunk["bytes"])
+        if data.get("type") == "content_block_delta":
+            text.write(data["delta"].get("text", ""))
+        elif data.get("type") == "message_delta":
+            stop_reason = data["delta"].get("stop_reason", stop_reason)
+    return text.getvalue(), stop_reason
+
+def build_request_body(prompt, max_tokens, cache_system_prompt=True):
+    system_block = {"type": "text", "text": SYSTEM_PROMPT}
+    if cache_system_prompt:
+        # Static instructions are an identical prefix on every call; let Bedrock cache them
+        system_block["cache_control"] = {"type": "ephemeral"}
+
+    return json.dumps({
+        "anthropic_version": "bedrock-2023-05-31",
+        "system": [system_block],
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": max_tokens,
+        "temperature": 0.2
+    })
+
+def call_claude(prompt, max_tokens=MAX_OUTPUT_TOKENS):
+    """
+    Return (response_text, model_id, stop_reason) for the model that actually produced the response.
+    REQUEST_VARIANTS are tried in order for this call only, and only while Bedrock rejects the model/latency settings.
+    """
+    for i, (model_id, latency, cache_system_prompt) in enumerate(REQUEST_VARIANTS):
+        payload = {
+            "modelId": model_id,
+            "contentType": "application/json",
+            "accept": "application/json",
+            "performanceConfigLatency": latency,
+            "body": build_request_body(prompt, max_tokens, cache_system_prompt=cache_system_prompt)
         }
-    
-    return field_map
-
-
+        try:
+            response = invoke_with_backoff(payload)
+        except bedrock.exceptions.ValidationException as e:
+            if i + 1 == len(REQUEST_VARIANTS) or not UNSUPPORTED_SETTINGS_PATTERN.search(str(e)):
+                raise
+            next_model_id, next_latency, _ = REQUEST_VARIANTS[i + 1]
+            print(f"Retrying with {next_model_id} and {next_latency} latency: {str(e)}")
+            continue
 
-def lambda_handler(event, context):
-    segment_list = event if isinstance(event, list) else [event]
-    updated_segments = []
+        response_text, stop_reason = read_stream_text(response)
+        return response_text.strip(), model_id, stop_reason
 
-    for segment_obj in segment_list:
-        segment = segment_obj.get("segment")
-        fields = segment_obj.get("fields", [])
+def parse_claude_response(response_text):
+    """Parse Claude's output into {segment: {field_id: {...JS code blocks...}}}."""
+    print("@@@@@@@@@@@@@@@Claude raw response:\n", response_text)
 
-        if not segment or not fields:
+    segment_map = {}
+    # re.split yields [preamble, segment, field, chunk, segment, field, chunk, ...]
+    sections = FIELD_HEADER_PATTERN.split(response_text)
+    for i in range(1, len(sections) - 2, 3):
+        segment, field_id, chunk = sections[i], sections[i + 1], sections[i + 2]
+        js_code = dict.fromkeys(CODE_BLOCK_KEYS.values(), "")
+        for block, code in CODE_BLOCK_PATTERN.findall(chunk):
+            js_code[CODE_BLOCK_KEYS[block]] = code
+        segment_map.setdefault(segment.strip(), {})[field_id.strip()] = js_code
+
+    return segment_map
+
+
+
+def get_cache_key(segment, fields, model_id):
+    """
+    Key on what reaches the prompt: the segment and each field's (Canonical Field, Source Field,
+    Transformation Rules). Per-run stats such as Fill Rate or Sample Input Values are left out.
+    """
+    field_inputs = [
+        (field["Canonical Field"], field.get("Source Field", ""), field.get("Transformation Rules", ""))
+        for field in fields
+    ]
+    payload = json.dumps({"s": segment, "f": field_inputs, "m": model_id, "p": PROMPT_VERSION})
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def get_cached_js_map(cache_key):
+    # The cache is only an optimisation: any read failure or corrupt entry is treated as a miss
+    try:
+        response = s3.get_object(Bucket=cache_bucket_name, Key=f"{CACHE_PREFIX}{cache_key}.json")
+        return json.loads(response["Body"].read())
+    except (ClientError, ValueError) as e:
+        if not isinstance(e, s3.exceptions.NoSuchKey):
+            print(f"Ignoring unreadable JS cache entry {cache_key}: {str(e)}")
+        return None
+
+def put_cached_js_map(cache_key, js_map):
+    try:
+        s3.put_object(
+            Bucket=cache_bucket_name,
+            Key=f"{CACHE_PREFIX}{cache_key}.json",
+            Body=json.dumps(js_map),
+            ContentType="application/json"
+        )
+    except ClientError as e:
+        print(f"Failed to cache JS for {cache_key}: {str(e)}")
+
+def get_cached_segment_js(segment, fields):
+    """Look up cached JS under each model call_claude may answer with, in the order it tries them."""
+    for model_id in CACHE_MODEL_IDS:
+        cached_js_map = get_cached_js_map(get_cache_key(segment, fields, model_id))
+        if cached_js_map is not None:
+            return cached_js_map
+    return None
+
+def is_complete_js_map(js_map, fields):
+    """True when every field has all three JS code blocks, i.e. the response was not truncated."""
+    return all(
+        all(js_map.get(field["Canonical Field"], {}).get(key) for key in CODE_BLOCK_KEYS.values())
+        for field in fields
+    )
+
+def output_token_budget(field_count):
+    return min(MAX_OUTPUT_TOKENS, OUTPUT_TOKENS_PER_FIELD * field_count + OUTPUT_TOKENS_BASE)
+
+def generate_js_codes(field_items, max_tokens):
+    """
+    Ask Claude for the JS of [(segment, field)] items in one call.
+    Returns {(segment, field_id): (js_code, model_id, truncated)} for the fields found in the response.
+    A response cut off at max_tokens is retried with the full output budget, then split in half,
+    so truncated is only True for a single field that still does not fit.
+    """
+    prompt = build_claude_prompt([{"segment": segment, "fields": [field]} for segment, field in field_items])
+    response_text, model_id, stop_reason = call_claude(prompt, max_tokens=max_tokens)
+
+    if stop_reason == "max_tokens":
+        if max_tokens < MAX_OUTPUT_TOKENS:
+            print(f"Response for {len(field_items)} fields hit max_tokens={max_tokens}; retrying with {MAX_OUTPUT_TOKENS}")
+            return generate_js_codes(field_items, MAX_OUTPUT_TOKENS)
+        if len(field_items) > 1:
+            print(f"Response for {len(field_items)} fields hit max_tokens={max_tokens}; splitting the fields in half")
+            mid = len(field_items) // 2
+            js_codes = generate_js_codes(field_items[:mid], output_token_budget(mid))
+            js_codes.update(generate_js_codes(field_items[mid:], output_token_budget(len(field_items) - mid)))
+            return js_codes
+
+    parsed_map = parse_claude_response(response_text)
+    truncated = stop_reason == "max_tokens"
+    js_codes = {}
+    for segment, field in field_items:
+        js_code = parsed_map.get(segment, {}).get(field["Canonical Field"])
+        if js_code is not None:
+            js_codes[(segment, field["Canonical Field"])] = (js_code, model_id, truncated)
+    return js_codes
+
+def process_segment_group(segment_group):
+    """Generate JS for a packed group of segments with at most one Claude call."""
+    segment_map = {}
+    pending = []
+    for segment_obj in segment_group:
+        segment = segment_obj["segment"]
+        js_map = {}
+        llm_fields = []
+        for field in segment_obj["fields"]:
+            js_code = synthesize_js(field)
+            if js_code is None:
+                llm_fields.append(field)
+            else:
+                js_map[field["Canonical Field"]] = js_code
+        segment_map[segment] = js_map
+
+        if not llm_fields:
             continue
-
-        for field in fields:
+        cached_js_map = get_cached_segment_js(segment, llm_fields)
+        if cached_js_map is None:
+            pending.append({"segment": segment, "fields": llm_fields})
+        else:
+            js_map.update(cached_js_map)
+
+    if pending:
+        field_items = [(segment_obj["segment"], field) for segment_obj in pending for field in segment_obj["fields"]]
+        for _, field in field_items:
             field["Canonical Field JS Code"] = get_canonical_js_code(field["Canonical Field"])
 
-        prompt = build_claude_prompt(segment, fields)
-        response_text = call_claude(prompt)
-        js_map = parse_claude_response(response_text, fields)
+        js_codes = generate_js_codes(field_items, output_token_budget(len(field_items)))
+
+        for segment_obj in pending:
+            segment = segment_obj["segment"]
+            js_map = {}
+            model_ids = set()
+            truncated = False
+            for field in segment_obj["fields"]:
+                field_id = field["Canonical Field"]
+                if (segment, field_id) in js_codes:
+                    js_map[field_id], model_id, field_truncated = js_codes[(segment, field_id)]
+                    model_ids.add(model_id)
+                    truncated = truncated or field_truncated
+            segment_map[segment].update(js_map)
+            # A truncated or partial response would otherwise be served from the cache forever
+            if not truncated and len(model_ids) == 1 and is_complete_js_map(js_map, segment_obj["fields"]):
+                put_cached_js_map(get_cache_key(segment, segment_obj["fields"], model_ids.pop()), js_map)
+            else:
+                print(f"Not caching incomplete JS for segment {segment}")
+
+    results = []
+    for segment_obj in segment_group:
+        segment = segment_obj["segment"]
+        fields = segment_obj["fields"]
+        js_map = segment_map.get(segment, {})
 
         for field in fields:
             field_id = field["Canonical Field"]
@@ -295,9 +555,27 @@ def lambda_handler(event, context):
             field["Source Field JS Code"] = js_map.get(field_id, {}).get("Source Field JS Code", "")
             field["Canonical-Source Field JS Code"] = js_map.get(field_id, {}).get("Canonical-Source Field JS Code", "")
 
-        updated_segments.append({
+        results.append({
             "segment": segment,
             "fields": fields
         })
 
-    return updated_segments
+    return results
+
+def lambda_handler(event, context):
+    segment_list = event if isinstance(event, list) else [event]
+    segment_list = [
+        {"segment": segment_obj.get("segment"), "fields": segment_obj.get("fields", [])}
+        for segment_obj in segment_list
+        if segment_obj.get("segment") and segment_obj.get("fields")
+    ]
+    if not segment_list:
+        return []
+
+    segment_groups = pack_segments(segment_list)
+
+    # Claude calls are network-bound, so groups are processed concurrently (order preserved)
+    with ThreadPoolExecutor(max_workers=min(len(segment_groups), MAX_CONCURRENT_SEGMENTS)) as executor:
+        group_results = list(executor.map(process_segment_group, segment_groups))
+
+    return [result for results in group_results for result in results]
@@ -1,7 +1,17 @@
 import json
+import os
 import boto3
+from botocore.config import Config
 
-stepfunctions = boto3.client("stepfunctions")
+# Keep the connection warm between UI polls; request shapes are fixed, so client-side validation is skipped
+BOTO_CONFIG = Config(
+    retries={"mode": "adaptive", "max_attempts": 10},
+    parameter_validation=False,
+    tcp_keepalive=True
+)
+
+_SESSION = boto3.Session()
+stepfunctions = _SESSION.client("stepfunctions", config=BOTO_CONFIG)
 
 pipeline_steps = {
     "ParseHL7Messages": "Parsing HL7 Messages",
@@ -15,6 +25,67 @@ pipeline_steps = {
     "AggregateResults": "Finalizing Results"
 }
 
+# Position of each step in the pipeline, computed once per container
+STEP_NAMES = tuple(pipeline_steps)
+STEP_INDEX = {name: i for i, name in enumerate(STEP_NAMES)}
+N_STEPS = len(STEP_NAMES)
+
+# History events fetched per page; progress only needs the most recent ones
+HISTORY_PAGE_SIZE = 50
+# executionArn -> (newest history event id seen, completed step index), reused across warm invocations
+_HISTORY_CACHE = {}
+HISTORY_CACHE_MAX_ENTRIES = 256
+
+# Response bodies are compact unless JSON_INDENT is set (e.g. for debugging)
+JSON_INDENT = int(os.environ.get("JSON_INDENT", "0")) or None
+JSON_SEPARATORS = (",", ": ") if JSON_INDENT else (",", ":")
+
+def to_json_body(obj):
+    return json.dumps(obj, indent=JSON_INDENT, separators=JSON_SEPARATORS)
+
+def get_completed_step_index(execution_arn):
+    """
+    Return the index in STEP_NAMES of the latest completed pipeline task, or -1.
+    History is read newest-first and the scan stops at the first pipeline task exit,
+    or at events already seen by a previous poll of the same execution.
+    """
+    last_event_id, current_index = _HISTORY_CACHE.get(execution_arn, (0, -1))
+    if current_index == N_STEPS - 1:
+        return current_index
+    newest_event_id = last_event_id
+
+    request = {
+        "executionArn": execution_arn,
+        "maxResults": HISTORY_PAGE_SIZE,
+        "reverseOrder": True
+    }
+    done = False
+    while not done:
+        history = stepfunctions.get_execution_history(**request)
+        for event in history.get("events", []):
+            if event["id"] <= last_event_id:
+                done = True
+                break
+            newest_event_id = max(newest_event_id, event["id"])
+            if event["type"] == "TaskStateExited":
+                idx = STEP_INDEX.get(event["stateExitedEventDetails"]["name"], -1)
+                if idx >= 0:
+                    # Steps run in sequence, so the latest exit is the furthest step reached
+                    if idx > current_index:
+                        current_index = idx
+                    done = True
+                    break
+
+        next_token = history.get("nextToken")
+        if not next_token:
+            break
+        request["nextToken"] = next_token
+
+    if execution_arn not in _HISTORY_CACHE and len(_HISTORY_CACHE) >= HISTORY_CACHE_MAX_ENTRIES:
+        _HISTORY_CACHE.pop(next(iter(_HISTORY_CACHE)))
+    _HISTORY_CACHE[execution_arn] = (newest_event_id, current_index)
+    return current_index
+
 def lambda_handler(event, context):
     cors_headers = {
         "Access-Control-Allow-Origin": "*",
@@ -27,7 +98,7 @@ def lambda_handler(event, context):
         return {
             "statusCode": 200,
             "headers": cors_headers,
-            "body": json.dumps({"message": "CORS preflight OK"})
+            "body": to_json_body({"message": "CORS preflight OK"})
         }
 
     query_params = event.get("queryStringParameters", {})
@@ -38,7 +109,7 @@ def lambda_handler(event, context):
         return {
             "statusCode": 400,
             "headers": cors_headers,
-            "body": json.dumps({"error": "Missing 'executionArn' query parameter"})
+            "body": to_json_body({"error": "Missing 'executionArn' query parameter"})
         }
 
     try:
@@ -63,7 +134,7 @@ def lambda_handler(event, context):
                 return {
                     "statusCode": 400,
                     "headers": cors_headers,
-                    "body": json.dumps({"error": f"Invalid report type '{report_type}'. Use 'specification' or 'validation'."})
+                    "body": to_json_body({"error": f"Invalid report type '{report_type}'. Use 'specification' or 'validation'."})
                 }
 
             if download_url:
@@ -75,27 +146,11 @@ def lambda_handler(event, context):
                     }
                 }
 
-        history = stepfunctions.get_execution_history(
-            executionArn=execution_arn,
-            maxResults=1000,
-            reverseOrder=False
-        )
-
-        completed_states = {
-            event["stateExitedEventDetails"]["name"]
-            for event in history.get("events", [])
-            if event["type"] == "TaskStateExited"
-        }
-
-        all_steps = list(pipeline_steps.keys())
-        current_index = max(
-            (i for i, step in enumerate(all_steps) if step in completed_states),
-            default=-1
-        )
-        current_step_key = all_steps[current_index + 1] if current_index + 1 < len(all_steps) else "Completed"
+        current_index = get_completed_step_index(execution_arn)
+        current_step_key = STEP_NAMES[current_index + 1] if current_index + 1 < N_STEPS else "Completed"
         current_step = pipeline_steps.get(current_step_key, current_step_key)
 
-        progress_percent = "100%" if status == "SUCCEEDED" else f"{int(((current_index + 1) / len(all_steps)) * 100)}%"
+        progress_percent = "100%" if status == "SUCCEEDED" else f"{int(((current_index + 1) / N_STEPS) * 100)}%"
 
         result = {
             "executionArn": execution_arn,
@@ -109,18 +164,18 @@ def lambda_handler(event, context):
         return {
             "statusCode": 200,
             "headers": cors_headers,
-            "body": json.dumps(result, indent=2)
+            "body": to_json_body(result)
         }
 
     except stepfunctions.exceptions.ExecutionDoesNotExist as e:
         return {
             "statusCode": 404,
             "headers": cors_headers,
-            "body": json.dumps({"error": "Execution not found", "details": str(e)})
+            "body": to_json_body({"error": "Execution not found", "details": str(e)})
         }
     except Exception as e:
         return {
             "statusCode": 500,
             "headers": cors_headers,
-            "body": json.dumps({"error": "Failed to retrieve execution", "details": str(e)})
+            "body": to_json_body({"error": "Failed to retrieve execution", "details": str(e)})
         }
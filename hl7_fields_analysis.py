@@ -1,15 +1,54 @@
 import json
+import os
 import boto3
+from botocore.config import Config
 import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 ATHENA_DATABASE = "hl7v2_db"
 ATHENA_OUTPUT = "s3://hl7v2autoct/output/analyzed_hl7v2_data/"
 RULESET_BUCKET = "hl7v2autoct"
 RULESET_KEY = "config/ruleset/hl7_ruleset.json"
+# Upper bound on concurrent per-segment Athena queries
+MAX_CONCURRENT_QUERIES = 8
+# Athena polling: exponential backoff from the initial delay up to the cap, within the timeout (seconds)
+QUERY_POLL_INITIAL_DELAY = 0.2
+QUERY_POLL_MAX_DELAY = 2
+# A segment query scans its table twice per field, so its timeout grows with the field count
+QUERY_TIMEOUT = int(os.environ.get("ATHENA_QUERY_TIMEOUT", "30"))
+QUERY_TIMEOUT_PER_FIELD = int(os.environ.get("ATHENA_QUERY_TIMEOUT_PER_FIELD", "5"))
+# Per-field fallback queries run a few at a time so the retries stay within Athena's DML concurrency quota
+MAX_CONCURRENT_FALLBACK_QUERIES = 4
+# Distinct values collected per field; an unbounded ARRAY_AGG(DISTINCT) is too costly on high-cardinality columns
+SAMPLE_VALUES_LIMIT = 100
+# Concurrent delete_objects batches when clearing the Athena output folder
+MAX_CONCURRENT_DELETES = 16
 
-s3 = boto3.client("s3")
-athena = boto3.client("athena")
+# Pool sized for the concurrent query and delete workers; request shapes are fixed, so client-side validation is skipped
+BOTO_CONFIG = Config(
+    retries={"mode": "adaptive", "max_attempts": 10},
+    max_pool_connections=64,
+    parameter_validation=False,
+    tcp_keepalive=True
+)
+
+# One session per container, shared by all clients
+_SESSION = boto3.Session()
+s3 = _SESSION.client("s3", config=BOTO_CONFIG)
+athena = _SESSION.client("athena", config=BOTO_CONFIG)
+
+# Parsed ruleset kept across warm invocations, revalidated by ETag
+_RULESET_CACHE = {"etag": None, "data": None}
+
+def load_ruleset():
+    """Return the parsed HL7 ruleset, downloading it only when its ETag has changed."""
+    head = s3.head_object(Bucket=RULESET_BUCKET, Key=RULESET_KEY)
+    if head["ETag"] != _RULESET_CACHE["etag"]:
+        ruleset_obj = s3.get_object(Bucket=RULESET_BUCKET, Key=RULESET_KEY)
+        _RULESET_CACHE["data"] = json.loads(ruleset_obj["Body"].read().decode("utf-8"))
+        _RULESET_CACHE["etag"] = ruleset_obj["ETag"]
+    return _RULESET_CACHE["data"]
 
 def clear_s3_folder(bucket, prefix):
     """
@@ -27,20 +66,26 @@ def clear_s3_folder(bucket, prefix):
         pages = paginator.paginate(Bucket=bucket, Prefix=prefix)
         
         delete_count = 0
-        for page in pages:
-            if 'Contents' not in page:
-                print(f"No objects found under {prefix}")
-                continue
-            
-            # Prepare objects for deletion (max 1000 per batch)
-            objects_to_delete = [{'Key': obj['Key']} for obj in page['Contents']]
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DELETES) as executor:
+            # Each page's delete is submitted as soon as it is listed, overlapping with the next list call
+            futures = []
+            for page in pages:
+                if 'Contents' not in page:
+                    print(f"No objects found under {prefix}")
+                    continue
+                
+                # Prepare objects for deletion (max 1000 per batch)
+                objects_to_delete = [{'Key': obj['Key']} for obj in page['Contents']]
+                
+                if objects_to_delete:
+                    futures.append(executor.submit(
+                        s3.delete_objects,
+                        Bucket=bucket,
+                        Delete={'Objects': objects_to_delete}
+                    ))
             
-            if objects_to_delete:
-                # Delete objects in batch
-                response = s3.delete_objects(
-                    Bucket=bucket,
-                    Delete={'Objects': objects_to_delete}
-                )
+            for future in as_completed(futures):
+                response = future.result()
                 deleted = len(response.get('Deleted', []))
                 delete_count += deleted
                 print(f"Deleted {deleted} objects from {prefix}")
@@ -58,34 +103,154 @@ def clear_s3_folder(bucket, prefix):
         raise
 
 def run_athena_query(query):
+    """Start the query and return its QueryExecutionId without waiting for it."""
     response = athena.start_query_execution(
         QueryString=query,
         QueryExecutionContext={"Database": ATHENA_DATABASE},
         ResultConfiguration={"OutputLocation": ATHENA_OUTPUT}
     )
-    query_execution_id = response["QueryExecutionId"]
+    return response["QueryExecutionId"]
+
+def query_timeout(field_count):
+    return QUERY_TIMEOUT + QUERY_TIMEOUT_PER_FIELD * max(field_count - 1, 0)
 
-    for _ in range(30):  # Wait up to 30 seconds
+def await_query(query_execution_id, timeout=QUERY_TIMEOUT):
+    """
+    Poll a started query with exponential backoff.
+    Returns (state, rows): rows is a lazy iterator over all result rows (every page, header first) when the
+    state is SUCCEEDED, otherwise None. A query still running at the timeout is stopped and reported as TIMED_OUT.
+    """
+    delay = QUERY_POLL_INITIAL_DELAY
+    deadline = time.monotonic() + timeout
+    while True:
         status = athena.get_query_execution(QueryExecutionId=query_execution_id)
         state = status["QueryExecution"]["Status"]["State"]
         if state in ["SUCCEEDED", "FAILED", "CANCELLED"]:
             break
-        time.sleep(1)
+        if time.monotonic() >= deadline:
+            # Stop the query so it does not keep scanning (and holding a concurrency slot) after we give up
+            athena.stop_query_execution(QueryExecutionId=query_execution_id)
+            state = "TIMED_OUT"
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, QUERY_POLL_MAX_DELAY)
 
     if state != "SUCCEEDED":
-        print(f"Query failed or timed out: {state}")
-        return None
+        print(f"Query {query_execution_id} did not succeed: {state}")
+        return state, None
+
+    # get_query_results returns at most 1000 rows per call
+    paginator = athena.get_paginator("get_query_results")
+    pages = paginator.paginate(QueryExecutionId=query_execution_id)
+    return state, (row for page in pages for row in page["ResultSet"]["Rows"])
+
+def parse_athena_result(rows):
+    """Map each result row to {field_id: stats}, keyed by the query's field_id column."""
+    rows = iter(rows)
+    header_row = next(rows, None)
+    if header_row is None:
+        return {}
+    headers = [col.get("VarCharValue", "") for col in header_row["Data"]]
+
+    stats_by_field = {}
+    for row in rows:
+        stats = dict(zip(headers, [col.get("VarCharValue", "") for col in row["Data"]]))
+        stats_by_field[stats.pop("field_id")] = stats
+    return stats_by_field
+
+def fetch_query_stats(query_execution_id, timeout=QUERY_TIMEOUT):
+    """Return (state, {field_id: stats}) for a started query; stats is None unless the state is SUCCEEDED."""
+    state, rows = await_query(query_execution_id, timeout)
+    return state, parse_athena_result(rows) if rows is not None else None
+
+def run_segment_queries(queries, timeouts):
+    """Run the queries concurrently and return their fetch_query_stats results in input order."""
+    # Start every query before waiting on any, so their execution overlaps in Athena
+    with ThreadPoolExecutor(max_workers=min(len(queries), MAX_CONCURRENT_QUERIES)) as executor:
+        query_ids = list(executor.map(run_athena_query, queries))
+        return list(executor.map(fetch_query_stats, query_ids, timeouts))
+
+def run_field_queries(queries):
+    """Run single-field queries through a small bounded pool; each worker starts its next query only after the last one ends."""
+    def run_and_fetch(query):
+        return fetch_query_stats(run_athena_query(query), query_timeout(1))
+
+    with ThreadPoolExecutor(max_workers=min(len(queries), MAX_CONCURRENT_FALLBACK_QUERIES)) as executor:
+        return list(executor.map(run_and_fetch, queries))
+
+def build_segment_stats_query(segment, field_ids):
+    """
+    One UNION ALL query covering every enabled field of a segment's table.
+    Each branch joins the field's aggregate stats with a bounded sample of its distinct values.
+    """
+    table_name = f"hl7_segment_{segment.lower()}"
+    selects = []
+    for field_id in field_ids:
+        column_name = f'"{field_id}"'
+        field_literal = field_id.replace("'", "''")
+        selects.append(f"""
+        SELECT
+            '{field_literal}' AS field_id,
+            field_stats.total_rows,
+            field_stats.filled_rows,
+            field_stats.fill_rate,
+            field_stats.min_length,
+            field_stats.max_length,
+            field_stats.distinct_count,
+            CAST(field_sample.sample_values AS JSON) AS sample_values
+        FROM (
+            SELECT
+                COUNT(*) AS total_rows,
+                COUNT({column_name}) AS filled_rows,
+                ROUND(COUNT({column_name}) * 100.0 / NULLIF(COUNT(*), 0), 2) AS fill_rate,
+                MIN(length({column_name})) AS min_length,
+                MAX(length({column_name})) AS max_length,
+                approx_distinct({column_name}) AS distinct_count
+            FROM {table_name}
+            WHERE {column_name} IS NOT NULL
+        ) field_stats
+        CROSS JOIN (
+            SELECT ARRAY_AGG(v) AS sample_values
+            FROM (
+                SELECT DISTINCT {column_name} AS v
+                FROM {table_name}
+                WHERE {column_name} IS NOT NULL
+                LIMIT {SAMPLE_VALUES_LIMIT}
+            )
+        ) field_sample""")
+    return "\n        UNION ALL".join(selects) + ";"
 
-    result = athena.get_query_results(QueryExecutionId=query_execution_id)
-    return result
 
-def parse_athena_result(result):
-    rows = result["ResultSet"]["Rows"]
-    if len(rows) < 2:
+def collect_field_stats(field_ids_by_segment):
+    """
+    Return {segment: {field_id: stats}} using one UNION ALL query per segment table.
+    A single failing branch fails its whole query, so FAILED segments are retried one field per query.
+    Timed-out segments are not retried: their per-field queries would scan the same data again.
+    """
+    if not field_ids_by_segment:
         return {}
-    headers = [col.get("VarCharValue", "") for col in rows[0]["Data"]]
-    values = [col.get("VarCharValue", "") for col in rows[1]["Data"]]
-    return dict(zip(headers, values))
+
+    segments = list(field_ids_by_segment)
+    print(f"Running Athena queries for segments: {', '.join(segments)}")
+    queries = [build_segment_stats_query(segment, field_ids_by_segment[segment]) for segment in segments]
+    timeouts = [query_timeout(len(field_ids_by_segment[segment])) for segment in segments]
+    results = dict(zip(segments, run_segment_queries(queries, timeouts)))
+    stats_by_segment = {segment: stats or {} for segment, (_, stats) in results.items()}
+
+    retry_fields = [
+        (segment, field_id)
+        for segment, (state, _) in results.items()
+        if state == "FAILED" and len(field_ids_by_segment[segment]) > 1
+        for field_id in field_ids_by_segment[segment]
+    ]
+    if retry_fields:
+        print(f"Retrying failed segment queries per field: {', '.join(sorted({s for s, _ in retry_fields}))}")
+        queries = [build_segment_stats_query(segment, [field_id]) for segment, field_id in retry_fields]
+        for (segment, _), (_, stats) in zip(retry_fields, run_field_queries(queries)):
+            stats_by_segment[segment].update(stats or {})
+
+    return stats_by_segment
+
 
 def lambda_handler(event, context):
     print("Lambda triggered with input:")
@@ -110,8 +275,7 @@ def lambda_handler(event, context):
         # Continue execution even if cleanup fails
 
     # Load HL7 ruleset from S3
-    ruleset_obj = s3.get_object(Bucket=RULESET_BUCKET, Key=RULESET_KEY)
-    ruleset = json.loads(ruleset_obj["Body"].read().decode("utf-8"))
+    ruleset = load_ruleset()
 
     # Filter enabled fields
     enabled_fields = []
@@ -126,29 +290,18 @@ def lambda_handler(event, context):
                     "ruleset": field_info.get("ruleset", [])
                 })
 
-    # Enrich fields using Athena
+    # Enrich fields using Athena: one query per segment table, run concurrently
+    field_ids_by_segment = defaultdict(list)
+    for field in enabled_fields:
+        field_ids_by_segment[field["segment"]].append(field["field_id"])
+
+    stats_by_segment = collect_field_stats(field_ids_by_segment)
+
     enriched_fields = []
     for field in enabled_fields:
         segment = field["segment"]
         field_id = field["field_id"]
-        table_name = f"hl7_segment_{segment.lower()}"
-        column_name = f'"{field_id}"'
-
-        query = f"""
-        SELECT
-            COUNT(*) AS total_rows,
-            COUNT({column_name}) AS filled_rows,
-            ROUND(COUNT({column_name}) * 100.0 / COUNT(*), 2) AS fill_rate,
-            MIN(length({column_name})) AS min_length,
-            MAX(length({column_name})) AS max_length,
-            CAST(ARRAY_AGG(DISTINCT {column_name}) AS JSON) AS all_values
-        FROM {table_name}
-        WHERE {column_name} IS NOT NULL;
-        """
-
-        print(f"Running Athena query for {segment}-{field_id}")
-        result = run_athena_query(query)
-        stats = parse_athena_result(result) if result else {}
+        stats = stats_by_segment[segment].get(field_id, {})
         print(f"Stats for {segment}-{field_id}: {json.dumps(stats)}")
 
         enriched_fields.append({
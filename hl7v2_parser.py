@@ -1,26 +1,43 @@
 import json
-import re
+import sys
+import orjson
 import boto3
-import pandas as pd
+from botocore.config import Config
 import pyarrow as pa
 import pyarrow.parquet as pq
-from io import BytesIO
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
-# HL7 message split pattern
-HL7_SPLIT_PATTERN = r'MSH\|'
+# Literal header that starts every HL7 message
+HL7_MESSAGE_HEADER = 'MSH|'
+# Concurrent delete_objects batches when clearing the parsed output folder
+MAX_CONCURRENT_DELETES = 8
+# Concurrent Parquet encode + upload workers, one segment table each
+MAX_CONCURRENT_UPLOADS = 16
+
+# Clients are created once per container; the pool covers the concurrent deletes and uploads
+BOTO_CONFIG = Config(
+    max_pool_connections=32,
+    retries={'mode': 'adaptive', 'max_attempts': 5},
+    tcp_keepalive=True
+)
+
+s3 = boto3.client('s3', config=BOTO_CONFIG)
+stepfunctions = boto3.client('stepfunctions', config=BOTO_CONFIG)
 
 # Load schema from S3
 def load_schema_from_s3():
-    s3 = boto3.client('s3')
     schema_bucket = 'hl7v2autoct'
     schema_key = 'config/schema/hl7_segment_schema.json'
     obj = s3.get_object(Bucket=schema_bucket, Key=schema_key)
-    schema_data = obj['Body'].read().decode('utf-8')
-    return json.loads(schema_data)
+    return orjson.loads(obj['Body'].read())
 
 SEGMENT_SCHEMA = load_schema_from_s3()
+# Segment names with a Parquet table; the schema is constant for the container's lifetime
+SEGMENT_SCHEMA_KEYS = frozenset(SEGMENT_SCHEMA)
+# Interned "<segment>-<field>" column names per schema segment, filled on first use and reused for every row
+COLUMN_NAME_CACHE = {segment: {} for segment in SEGMENT_SCHEMA_KEYS}
 
 def clear_s3_folder(bucket, prefix):
     """
@@ -30,7 +47,6 @@ def clear_s3_folder(bucket, prefix):
         bucket: S3 bucket name
         prefix: S3 prefix/folder path (without leading slash, with trailing slash)
     """
-    s3 = boto3.client('s3')
     try:
         print(f"Clearing S3 folder: s3://{bucket}/{prefix}")
         
@@ -39,20 +55,26 @@ def clear_s3_folder(bucket, prefix):
         pages = paginator.paginate(Bucket=bucket, Prefix=prefix)
         
         delete_count = 0
-        for page in pages:
-            if 'Contents' not in page:
-                print(f"No objects found under {prefix}")
-                continue
-            
-            # Prepare objects for deletion (max 1000 per batch)
-            objects_to_delete = [{'Key': obj['Key']} for obj in page['Contents']]
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DELETES) as executor:
+            # Each page's delete is submitted as soon as it is listed, overlapping with the next list call
+            futures = []
+            for page in pages:
+                if 'Contents' not in page:
+                    print(f"No objects found under {prefix}")
+                    continue
+                
+                # Prepare objects for deletion (max 1000 per batch)
+                objects_to_delete = [{'Key': obj['Key']} for obj in page['Contents']]
+                
+                if objects_to_delete:
+                    futures.append(executor.submit(
+                        s3.delete_objects,
+                        Bucket=bucket,
+                        Delete={'Objects': objects_to_delete}
+                    ))
             
-            if objects_to_delete:
-                # Delete objects in batch
-                response = s3.delete_objects(
-                    Bucket=bucket,
-                    Delete={'Objects': objects_to_delete}
-                )
+            for future in as_completed(futures):
+                response = future.result()
                 deleted = len(response.get('Deleted', []))
                 delete_count += deleted
                 print(f"Deleted {deleted} objects from {prefix}")
@@ -70,44 +92,32 @@ def clear_s3_folder(bucket, prefix):
         raise
 
 def getSegments(msg):
-    return re.split(r'\r|\n', msg.strip())
+    # HL7 terminates segments with \r; normalize \n so \r\n and bare \n files split the same way
+    segments = msg.strip().replace('\n', '\r').split('\r')
+    return [segment for segment in segments if segment.strip()]
+
+# Split one repetition into components, and components containing '&' into subcomponents
+def split_components(rep):
+    if '&' not in rep:
+        return rep.split('^')
+    return [comp.split('&') if '&' in comp else comp for comp in rep.split('^')]
 
 # Parse HL7 field into nested list structure
 def parse_field(field):
-    repetitions = field.split('~')
-    if len(repetitions) == 1:
-        components = repetitions[0].split('^')
-        comp_list = []
-        for comp in components:
-            if '&' in comp:
-                subcomps = comp.split('&')
-                comp_list.append(subcomps)
-            else:
-                comp_list.append(comp)
-        return comp_list if len(comp_list) > 1 else comp_list[0]
-    else:
-        parsed = []
-        for rep in repetitions:
-            components = rep.split('^')
-            comp_list = []
-            for comp in components:
-                if '&' in comp:
-                    subcomps = comp.split('&')
-                    comp_list.append(subcomps)
-                else:
-                    comp_list.append(comp)
-            parsed.append(comp_list)
-        return parsed
-
-# Convert HL7 message to structured JSON
+    # Most fields are plain values with no delimiters
+    if '^' not in field and '~' not in field and '&' not in field:
+        return field
+    if '~' in field:
+        return [split_components(rep) for rep in field.split('~')]
+    components = split_components(field)
+    return components if len(components) > 1 else components[0]
+
+# Convert HL7 message to structured JSON: {segment name: [segment dict, ...]}
 def hl7_to_custom_json(HL7Message):
     result = defaultdict(list)
     segments = getSegments(HL7Message)
 
     for segment in segments:
-        if not segment.strip():
-            continue
-
         parts = segment.strip().split('|')
         seg_name = parts[0]
         seg_data = {}
@@ -128,74 +138,95 @@ def hl7_to_custom_json(HL7Message):
 
         result[seg_name].append(seg_data)
 
-    for key in result:
-        if len(result[key]) == 1:
-            result[key] = result[key][0]
-
     return dict(result)
 
 # Split multiple HL7 messages
 def split_hl7_messages(raw_data):
-    chunks = re.split(HL7_SPLIT_PATTERN, raw_data.strip())
-    return [chunk if chunk.startswith("MSH|") else "MSH|" + chunk for chunk in chunks if chunk.strip()]
+    chunks = raw_data.strip().split(HL7_MESSAGE_HEADER)
+    return [HL7_MESSAGE_HEADER + chunk for chunk in chunks if chunk.strip()]
 
 def parse_multiple_hl7_messages(raw_data):
     messages = split_hl7_messages(raw_data)
     return [hl7_to_custom_json(msg) for msg in messages]
 
-# Serialize complex fields for Parquet compatibility
+# Serialize complex fields for Parquet compatibility (compact JSON)
 def serialize_field(value):
     if isinstance(value, (list, dict)):
-        return json.dumps(value)
+        return orjson.dumps(value).decode('utf-8')
     return value
 
-# Convert parsed messages into Parquet-compatible tables
-def convert_to_parquet_tables(parsed_messages, schema):
-    tables = defaultdict(list)
+# Append a row's value to a column, back-filling None for the rows where the column was absent
+def append_column_value(columns, name, row_index, value):
+    column = columns.get(name)
+    if column is None:
+        column = columns[name] = [None] * row_index
+    elif len(column) < row_index:
+        column.extend([None] * (row_index - len(column)))
+    column.append(value)
+
+# Convert parsed messages into Parquet-compatible tables, built column by column:
+# {segment: {"num_rows": n, "columns": {column name: [value per row]}}}
+def convert_to_parquet_tables(parsed_messages):
+    tables = defaultdict(lambda: {"num_rows": 0, "columns": {}})
 
     for msg in parsed_messages:
-        message_id = msg.get("MSH", {}).get("10", "")  # MSH-10
+        message_id = msg.get("MSH", [{}])[0].get("10", "")  # MSH-10
 
         for segment, entries in msg.items():
-            if segment not in schema:
+            if segment not in SEGMENT_SCHEMA_KEYS:
                 continue
 
-            if isinstance(entries, dict):
-                entries = [entries]
-
+            table = tables[segment]
+            columns = table["columns"]
+            column_names = COLUMN_NAME_CACHE[segment]
             for entry in entries:
-                row = {"message_control_id": message_id}
+                row_index = table["num_rows"]
+                append_column_value(columns, "message_control_id", row_index, message_id)
                 for key, value in entry.items():
-                    field_name = f"{segment}-{key}"
-                    row[field_name] = serialize_field(value)
-                tables[segment].append(row)
+                    column_name = column_names.get(key)
+                    if column_name is None:
+                        column_name = column_names[key] = sys.intern(f"{segment}-{key}")
+                    append_column_value(columns, column_name, row_index, serialize_field(value))
+                table["num_rows"] = row_index + 1
+
+    # Pad columns that were absent from the trailing rows
+    for table in tables.values():
+        for column in table["columns"].values():
+            column.extend([None] * (table["num_rows"] - len(column)))
 
     return tables
 
 # Store Parquet files in S3
-def store_parquet_to_s3(tables, bucket):
-    s3 = boto3.client('s3')
-    output_keys = []
-    for segment, rows in tables.items():
-        df = pd.DataFrame(rows)
-        table = pa.Table.from_pandas(df)
-        buffer = BytesIO()
-        pq.write_table(table, buffer)
-
-        output_key = f"output/parsed_hl7_segments/segment={segment}/hl7_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.parquet"
-        s3.put_object(
-            Bucket=bucket,
-            Key=output_key,
-            Body=buffer.getvalue(),
-            ContentType='application/octet-stream'
-        )
-
-        output_keys.append({
-            "segment": segment,
-            "s3_key": output_key
-        })
-
-    return output_keys
+def store_segment_parquet(segment, table_data, bucket, ts):
+    table = pa.table(table_data["columns"])
+    # Arrow-native sink: the encoded file is handed to S3 without a copy into Python bytes
+    sink = pa.BufferOutputStream()
+    pq.write_table(table, sink, compression='zstd', use_dictionary=True)
+
+    output_key = f"output/parsed_hl7_segments/segment={segment}/hl7_{ts}.parquet"
+    s3.put_object(
+        Bucket=bucket,
+        Key=output_key,
+        Body=pa.BufferReader(sink.getvalue()),
+        ContentType='application/octet-stream'
+    )
+
+    return {
+        "segment": segment,
+        "s3_key": output_key
+    }
+
+def store_parquet_to_s3(tables, bucket, ts):
+    if not tables:
+        return []
+
+    # Arrow releases the GIL while encoding and uploads are network-bound, so segments run concurrently (order preserved)
+    with ThreadPoolExecutor(max_workers=min(len(tables), MAX_CONCURRENT_UPLOADS)) as executor:
+        futures = [
+            executor.submit(store_segment_parquet, segment, table_data, bucket, ts)
+            for segment, table_data in tables.items()
+        ]
+        return [future.result() for future in futures]
 
 # Lambda entry point
 def lambda_handler(event, context):
@@ -216,39 +247,42 @@ def lambda_handler(event, context):
         if not hl7_raw:
             raise ValueError("Missing 'hl7_message' in event payload")
 
+        # One timestamp per invocation, shared by the archived input and every segment file
+        ts = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+
         # Target S3 bucket
         input_bucket = 'hl7v2autoct'
-        input_key = f"input/raw_hl7_messages/hl7_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.txt"
-
-        # Upload HL7 message to S3
-        s3 = boto3.client('s3')
-        s3.put_object(
-            Bucket=input_bucket,
-            Key=input_key,
-            Body=hl7_raw.encode('utf-8'),
-            ContentType='text/plain'
-        )
-        print(f"Uploaded HL7 message to s3://{input_bucket}/{input_key}")
-
-        # Cleanup parsed HL7 segments folder
-        try:
-            output_prefix = "output/parsed_hl7_segments/"
-            print(f"Cleaning up output folder before parsing: s3://{input_bucket}/{output_prefix}")
-            clear_s3_folder(input_bucket, output_prefix)
-        except Exception as cleanup_error:
-            print(f"Warning: Failed to cleanup output folder: {str(cleanup_error)}")
-
-        # Parse and store HL7 segments
-        obj = s3.get_object(Bucket=input_bucket, Key=input_key)
-        hl7_raw = obj['Body'].read().decode('utf-8')
-
-        parsed_messages = parse_multiple_hl7_messages(hl7_raw)
-        tables = convert_to_parquet_tables(parsed_messages, SEGMENT_SCHEMA)
-        output_keys = store_parquet_to_s3(tables, input_bucket)
-        print("output_keys:", output_keys)
+        input_key = f"input/raw_hl7_messages/hl7_{ts}.txt"
+
+        with ThreadPoolExecutor(max_workers=1) as archive_executor:
+            # Archive the HL7 message to S3 in the background; parsing uses the in-memory copy
+            archive_future = archive_executor.submit(
+                s3.put_object,
+                Bucket=input_bucket,
+                Key=input_key,
+                Body=hl7_raw.encode('utf-8'),
+                ContentType='text/plain'
+            )
+
+            # Cleanup parsed HL7 segments folder
+            try:
+                output_prefix = "output/parsed_hl7_segments/"
+                print(f"Cleaning up output folder before parsing: s3://{input_bucket}/{output_prefix}")
+                clear_s3_folder(input_bucket, output_prefix)
+            except Exception as cleanup_error:
+                print(f"Warning: Failed to cleanup output folder: {str(cleanup_error)}")
+
+            # Parse and store HL7 segments
+            parsed_messages = parse_multiple_hl7_messages(hl7_raw)
+            tables = convert_to_parquet_tables(parsed_messages)
+            output_keys = store_parquet_to_s3(tables, input_bucket, ts)
+            print("output_keys:", output_keys)
+
+            # The Step Function input references input_key, so the archive must exist before it starts
+            archive_future.result()
+            print(f"Uploaded HL7 message to s3://{input_bucket}/{input_key}")
 
         # Start Step Function
-        stepfunctions = boto3.client('stepfunctions')
         step_response = stepfunctions.start_execution(
             stateMachineArn="arn:aws:states:us-east-1:238845559334:stateMachine:HL7v2AutoCT",
             input=json.dumps({
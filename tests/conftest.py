@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The Lambda handlers are top-level modules that create boto3 clients at import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
@@ -0,0 +1,120 @@
+import json
+
+import pytest
+
+import evaluate_transformation_rules as evaluate
+
+
+class FakeClock:
+    """Stands in for the time module: sleep advances monotonic time instead of blocking."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(evaluate, "time", fake)
+    return fake
+
+
+def test_token_bucket_allows_burst_without_waiting(clock):
+    bucket = evaluate.TokenBucket(rate_per_sec=10, burst=100)
+
+    bucket.acquire(60)
+    bucket.acquire(40)
+
+    assert clock.sleeps == []
+    assert bucket.tokens == 0
+
+
+def test_token_bucket_blocks_until_refilled(clock):
+    bucket = evaluate.TokenBucket(rate_per_sec=10, burst=100)
+    bucket.acquire(100)
+
+    bucket.acquire(25)
+
+    assert clock.sleeps == [pytest.approx(2.5)]
+    assert bucket.tokens == pytest.approx(0)
+
+
+def test_token_bucket_refill_is_capped_at_burst(clock):
+    bucket = evaluate.TokenBucket(rate_per_sec=10, burst=100)
+    bucket.acquire(100)
+    clock.now += 3600
+
+    bucket.acquire(100)
+    bucket.acquire(10)
+
+    assert clock.sleeps == [pytest.approx(1.0)]
+
+
+def test_token_bucket_caps_cost_at_burst(clock):
+    bucket = evaluate.TokenBucket(rate_per_sec=10, burst=100)
+
+    bucket.acquire(500)
+
+    assert clock.sleeps == []
+    assert bucket.tokens == 0
+
+
+def test_est_tokens_includes_reserved_output_tokens():
+    assert evaluate.est_tokens("x" * 400) == 100 + evaluate.MAX_OUTPUT_TOKENS
+
+
+def test_request_body_reserves_max_output_tokens():
+    body = json.loads(evaluate.build_request_body("prompt"))
+
+    assert body["max_tokens"] == evaluate.MAX_OUTPUT_TOKENS
+    assert body["messages"] == [{"role": "user", "content": "prompt"}]
+
+
+@pytest.fixture
+def eval_cache(monkeypatch):
+    monkeypatch.setattr(evaluate, "_eval_cache", {})
+    monkeypatch.setattr(evaluate, "EVAL_CACHE_MAX_ENTRIES", 3)
+    return evaluate._eval_cache
+
+
+def test_eval_cache_evicts_oldest_entry_first(eval_cache, clock):
+    for key in ["a", "b", "c", "d"]:
+        evaluate.put_cached_evaluation(key, [key])
+
+    assert list(eval_cache) == ["b", "c", "d"]
+    assert evaluate.get_cached_evaluation("a") is None
+    assert evaluate.get_cached_evaluation("d") == ["d"]
+
+
+def test_eval_cache_overwrite_does_not_evict(eval_cache, clock):
+    for key in ["a", "b", "c"]:
+        evaluate.put_cached_evaluation(key, [key])
+
+    evaluate.put_cached_evaluation("a", ["a2"])
+
+    assert list(eval_cache) == ["a", "b", "c"]
+    assert evaluate.get_cached_evaluation("a") == ["a2"]
+
+
+def test_eval_cache_entries_expire(eval_cache, clock):
+    evaluate.put_cached_evaluation("a", ["a"])
+    clock.now += evaluate.EVAL_CACHE_TTL_SECONDS + 1
+
+    assert evaluate.get_cached_evaluation("a") is None
+    assert eval_cache == {}
+
+
+def test_eval_cache_key_ignores_field_key_order():
+    fields = [{"Canonical Field": "PID-5", "Source Field": "PID-5"}]
+    reordered = [{"Source Field": "PID-5", "Canonical Field": "PID-5"}]
+
+    assert evaluate.eval_cache_key("PID", fields) == evaluate.eval_cache_key("PID", reordered)
+    assert evaluate.eval_cache_key("PID", fields) != evaluate.eval_cache_key("PD1", fields)
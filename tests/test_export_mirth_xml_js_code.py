@@ -0,0 +1,59 @@
+import export_mirth_xml_js_code as export
+
+
+def baseline_replace(template_content, new_js_code):
+    """Line-based replacement the regex version must stay equivalent to."""
+    result_lines = []
+    capture = False
+    for line in template_content.split('\n'):
+        if '// START_JAVASCRIPT_CODE' in line:
+            result_lines.append(line)
+            result_lines.append(new_js_code)
+            capture = True
+            continue
+        elif '// END_JAVASCRIPT_CODE' in line:
+            result_lines.append(line)
+            capture = False
+            continue
+        if not capture:
+            result_lines.append(line)
+    return '\n'.join(result_lines)
+
+
+TEMPLATE = "\n".join([
+    "<channel>",
+    "  <step1>",
+    "    // START_JAVASCRIPT_CODE",
+    "    var stale = 1;",
+    "    // END_JAVASCRIPT_CODE",
+    "  </step1>",
+    "  <step2>",
+    "    // START_JAVASCRIPT_CODE step 2",
+    "    var stale = 2;",
+    "    var alsoStale = 3;",
+    "    // END_JAVASCRIPT_CODE",
+    "  </step2>",
+    "</channel>"
+])
+
+
+def test_replaces_every_javascript_block():
+    updated = export.replace_javascript_in_template(TEMPLATE, "  tmp['PID'] = 1;")
+
+    assert "stale" not in updated.lower()
+    assert updated.count("tmp['PID'] = 1;") == 2
+    assert updated == baseline_replace(TEMPLATE, "  tmp['PID'] = 1;")
+
+
+def test_keeps_backslashes_in_new_code():
+    new_js_code = "  var re = /\\d+\\1/;"
+
+    updated = export.replace_javascript_in_template(TEMPLATE, new_js_code)
+
+    assert updated == baseline_replace(TEMPLATE, new_js_code)
+
+
+def test_replaces_empty_block():
+    template = "a\n// START_JAVASCRIPT_CODE\n// END_JAVASCRIPT_CODE\nb"
+
+    assert export.replace_javascript_in_template(template, "x();") == baseline_replace(template, "x();")
@@ -0,0 +1,49 @@
+import pytest
+
+import generate_hl7v2_specification as spec
+
+
+@pytest.fixture(autouse=True)
+def empty_memo():
+    spec._flatten_memo.clear()
+    yield
+    spec._flatten_memo.clear()
+
+
+def test_format_value_list_flattens_hl7_values():
+    values = ['["Smith", "Jane"]', '[["LN", "GLU"], "1234"]', "plain", 5, None]
+
+    assert spec.format_value_list(values) == "Smith^Jane, LN&GLU^1234, plain, 5, None"
+
+
+def test_format_value_list_memoizes_string_values(monkeypatch):
+    calls = []
+    flatten_value = spec.flatten_value
+
+    def counting_flatten_value(value):
+        calls.append(value)
+        return flatten_value(value)
+
+    monkeypatch.setattr(spec, "flatten_value", counting_flatten_value)
+
+    first = spec.format_value_list(['["Smith", "Jane"]', '["Smith", "Jane"]'])
+    second = spec.format_value_list(['["Smith", "Jane"]'])
+
+    assert first == "Smith^Jane, Smith^Jane"
+    assert second == "Smith^Jane"
+    assert calls == [["Smith", "Jane"]]
+    assert spec._flatten_memo == {'["Smith", "Jane"]': "Smith^Jane"}
+
+
+def test_format_value_list_memoizes_empty_results(monkeypatch):
+    calls = []
+    monkeypatch.setattr(spec, "flatten_value", lambda value: calls.append(value) or "")
+
+    assert spec.format_value_list(["", ""]) == ""
+    assert len(calls) == 1
+
+
+def test_format_value_list_does_not_memoize_non_strings():
+    spec.format_value_list([["Smith", "Jane"], 7])
+
+    assert spec._flatten_memo == {}
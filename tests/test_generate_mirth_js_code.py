@@ -0,0 +1,515 @@
+import io
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+import generate_mirth_js_code as mirth
+
+
+def claude_block(segment, field, canonical, source, combined):
+    return (
+        f"=== SEGMENT: {segment} / FIELD: {field} ===\n\n"
+        "*** Canonical Field JS Code: ***\n"
+        f"** Start Canonical Code **\n{canonical}\n** End Canonical Code **\n\n"
+        "*** Source Field JS Code: ***\n"
+        f"** Start Source Code **\n{source}\n** End Source Code **\n\n"
+        "*** Canonical-Source Field JS Code: ***\n"
+        f"** Start Canonical-Source Code **\n{combined}\n** End Canonical-Source Code **\n\n"
+    )
+
+
+def pid5_block():
+    return claude_block(
+        "PID", "PID-5",
+        "tmp['PID']['PID.5']['PID.5.1'];",
+        "let tmpPID5 = msg['PID']['PID.5']['PID.5.1'].toString();",
+        "let tmpPID5 = msg['PID']['PID.5']['PID.5.1'].toString();\ntmp['PID']['PID.5']['PID.5.1'] = tmpPID5;"
+    )
+
+
+class FakeS3:
+    """In-memory stand-in for the get_object/put_object calls made by the JS cache."""
+
+    class exceptions:
+        class NoSuchKey(ClientError):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+        self.get_error = None
+        self.put_error = None
+
+    def get_object(self, Bucket, Key):
+        if self.get_error:
+            raise ClientError({"Error": {"Code": self.get_error}}, "GetObject")
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        if self.put_error:
+            raise ClientError({"Error": {"Code": self.put_error}}, "PutObject")
+        self.objects[Key] = Body.encode("utf-8") if isinstance(Body, str) else Body
+
+
+@pytest.fixture
+def fake_s3(monkeypatch):
+    fake = FakeS3()
+    monkeypatch.setattr(mirth, "s3", fake)
+    return fake
+
+
+@pytest.fixture
+def claude(monkeypatch):
+    """
+    Stub call_claude with a queue of canned responses and record the prompts it receives.
+    A queued (text, stop_reason) tuple simulates a response cut off at max_tokens.
+    """
+    calls = []
+    responses = []
+
+    def fake_call_claude(prompt, max_tokens=mirth.MAX_OUTPUT_TOKENS):
+        calls.append({"prompt": prompt, "max_tokens": max_tokens})
+        response = responses.pop(0)
+        response_text, stop_reason = response if isinstance(response, tuple) else (response, "end_turn")
+        return response_text, fake_call_claude.model_id, stop_reason
+
+    monkeypatch.setattr(mirth, "call_claude", fake_call_claude)
+    fake_call_claude.calls = calls
+    fake_call_claude.responses = responses
+    fake_call_claude.model_id = mirth.MODEL_ID
+    return fake_call_claude
+
+
+def pid_segment():
+    return {
+        "segment": "PID",
+        "fields": [
+            {"Canonical Field": "PID-5", "Source Field": "PID-5", "Transformation Rules": "Copy legal name"},
+            {"Canonical Field": "PID-8", "Source Field": "PID-8", "Transformation Rules": ""},
+            {"Canonical Field": "PID-9", "Source Field": "NA", "Transformation Rules": ""}
+        ]
+    }
+
+
+def test_process_segment_group_only_sends_rule_fields_to_claude(fake_s3, claude):
+    claude.responses.append(pid5_block())
+
+    [result] = mirth.process_segment_group([pid_segment()])
+
+    assert len(claude.calls) == 1
+    prompt = claude.calls[0]["prompt"]
+    assert "PID-5" in prompt
+    assert "PID-8" not in prompt
+    assert "PID-9" not in prompt
+
+    fields = {field["Canonical Field"]: field for field in result["fields"]}
+    assert fields["PID-5"]["Canonical-Source Field JS Code"].endswith("tmp['PID']['PID.5']['PID.5.1'] = tmpPID5;")
+    assert fields["PID-8"]["Canonical-Source Field JS Code"] == (
+        "tmp['PID']['PID.8']['PID.8.1'] = msg['PID']['PID.8']['PID.8.1'].toString();"
+    )
+    assert fields["PID-9"]["Source Field JS Code"] == '""'
+
+
+def test_process_segment_group_reuses_cached_js(fake_s3, claude):
+    claude.responses.append(pid5_block())
+    mirth.process_segment_group([pid_segment()])
+    assert len(fake_s3.objects) == 1
+
+    [result] = mirth.process_segment_group([pid_segment()])
+
+    assert len(claude.calls) == 1
+    assert result["fields"][0]["Canonical Field JS Code"] == "tmp['PID']['PID.5']['PID.5.1'];"
+
+
+def test_lambda_handler_preserves_segment_order(fake_s3, claude):
+    segments = [
+        {"segment": "MSH", "fields": [{"Canonical Field": "MSH-3", "Source Field": "MSH-3"}]},
+        {"segment": "EMPTY", "fields": []},
+        {"segment": "PV1", "fields": [{"Canonical Field": "PV1-8", "Source Field": "NA"}]}
+    ]
+
+    results = mirth.lambda_handler(segments, None)
+
+    assert [result["segment"] for result in results] == ["MSH", "PV1"]
+    assert claude.calls == []
+
+
+def segment_with_fields(name, count):
+    return {"segment": name, "fields": [{"Canonical Field": f"{name}-{i}"} for i in range(1, count + 1)]}
+
+
+def test_pack_segments_groups_small_segments():
+    segments = [segment_with_fields("PID", 3), segment_with_fields("PV1", 4), segment_with_fields("OBX", 2)]
+
+    groups = mirth.pack_segments(segments, max_fields=7)
+
+    assert [[s["segment"] for s in group] for group in groups] == [["PID", "PV1"], ["OBX"]]
+
+
+def test_pack_segments_keeps_oversized_segment_alone():
+    segments = [segment_with_fields("PID", 2), segment_with_fields("OBX", 9), segment_with_fields("PV1", 1)]
+
+    groups = mirth.pack_segments(segments, max_fields=5)
+
+    assert [[s["segment"] for s in group] for group in groups] == [["PID"], ["OBX"], ["PV1"]]
+
+
+def test_lambda_handler_packs_segments_into_one_claude_call(fake_s3, claude):
+    obx_block = claude_block(
+        "OBX", "OBX-5",
+        "tmp['OBX']['OBX.5']['OBX.5.1'];",
+        "let tmpOBX5 = msg['OBX']['OBX.5']['OBX.5.1'].toString();",
+        "let tmpOBX5 = msg['OBX']['OBX.5']['OBX.5.1'].toString();\ntmp['OBX']['OBX.5']['OBX.5.1'] = tmpOBX5;"
+    )
+    claude.responses.append(pid5_block() + obx_block)
+    segments = [
+        pid_segment(),
+        {"segment": "OBX", "fields": [{"Canonical Field": "OBX-5", "Source Field": "OBX-5", "Transformation Rules": "Trim"}]}
+    ]
+
+    results = mirth.lambda_handler(segments, None)
+
+    assert len(claude.calls) == 1
+    assert [result["segment"] for result in results] == ["PID", "OBX"]
+    assert results[1]["fields"][0]["Canonical Field JS Code"] == "tmp['OBX']['OBX.5']['OBX.5.1'];"
+
+
+def test_parse_claude_response_reads_every_field_block():
+    pid8_block = claude_block(
+        "PID", "PID-8",
+        "tmp['PID']['PID.8']['PID.8.1'];",
+        "msg['PID']['PID.8']['PID.8.1'].toString()",
+        "tmp['PID']['PID.8']['PID.8.1'] = msg['PID']['PID.8']['PID.8.1'].toString();"
+    )
+
+    segment_map = mirth.parse_claude_response("Here is the code:\n\n" + pid5_block() + pid8_block)
+
+    assert list(segment_map) == ["PID"]
+    assert list(segment_map["PID"]) == ["PID-5", "PID-8"]
+    assert segment_map["PID"]["PID-5"]["Source Field JS Code"] == (
+        "let tmpPID5 = msg['PID']['PID.5']['PID.5.1'].toString();"
+    )
+    assert segment_map["PID"]["PID-8"]["Canonical-Source Field JS Code"] == (
+        "tmp['PID']['PID.8']['PID.8.1'] = msg['PID']['PID.8']['PID.8.1'].toString();"
+    )
+
+
+def test_parse_claude_response_does_not_borrow_next_field_code():
+    pid7_block = claude_block(
+        "PID", "PID-7",
+        "tmp['PID']['PID.7']['PID.7.1'];",
+        "msg['PID']['PID.7']['PID.7.1'].toString()",
+        "tmp['PID']['PID.7']['PID.7.1'] = msg['PID']['PID.7']['PID.7.1'].toString();"
+    )
+    response_text = "=== SEGMENT: PID / FIELD: PID-5 ===\n\n(no code generated)\n\n" + pid7_block
+
+    segment_map = mirth.parse_claude_response(response_text)
+
+    assert segment_map["PID"]["PID-5"] == {
+        "Canonical Field JS Code": "",
+        "Source Field JS Code": "",
+        "Canonical-Source Field JS Code": ""
+    }
+    assert segment_map["PID"]["PID-7"]["Canonical Field JS Code"] == "tmp['PID']['PID.7']['PID.7.1'];"
+
+
+def test_parse_claude_response_keeps_partial_field_blocks():
+    truncated = pid5_block().split("*** Canonical-Source")[0]
+
+    segment_map = mirth.parse_claude_response(truncated)
+
+    js_code = segment_map["PID"]["PID-5"]
+    assert js_code["Canonical Field JS Code"] == "tmp['PID']['PID.5']['PID.5.1'];"
+    assert js_code["Source Field JS Code"] == "let tmpPID5 = msg['PID']['PID.5']['PID.5.1'].toString();"
+    assert js_code["Canonical-Source Field JS Code"] == ""
+
+
+def test_process_segment_group_does_not_cache_partial_response(fake_s3, claude):
+    truncated = pid5_block().split("*** Canonical-Source")[0]
+    claude.responses.extend([truncated, pid5_block()])
+
+    mirth.process_segment_group([pid_segment()])
+    assert fake_s3.objects == {}
+
+    [result] = mirth.process_segment_group([pid_segment()])
+
+    assert len(claude.calls) == 2
+    assert result["fields"][0]["Canonical-Source Field JS Code"].endswith("= tmpPID5;")
+    assert len(fake_s3.objects) == 1
+
+
+def test_process_segment_group_does_not_cache_missing_field(fake_s3, claude):
+    segment = pid_segment()
+    segment["fields"].append({"Canonical Field": "PID-11", "Source Field": "PID-11", "Transformation Rules": "Join"})
+    claude.responses.append(pid5_block())
+
+    [result] = mirth.process_segment_group([segment])
+
+    assert fake_s3.objects == {}
+    assert result["fields"][-1]["Canonical-Source Field JS Code"] == ""
+
+
+@pytest.mark.parametrize("error_code", ["AccessDenied", "SlowDown"])
+def test_process_segment_group_treats_cache_read_errors_as_miss(fake_s3, claude, error_code):
+    fake_s3.get_error = error_code
+    claude.responses.append(pid5_block())
+
+    [result] = mirth.process_segment_group([pid_segment()])
+
+    assert len(claude.calls) == 1
+    assert result["fields"][0]["Canonical Field JS Code"] == "tmp['PID']['PID.5']['PID.5.1'];"
+
+
+def test_process_segment_group_treats_corrupt_cache_entry_as_miss(fake_s3, claude):
+    claude.responses.extend([pid5_block(), pid5_block()])
+    mirth.process_segment_group([pid_segment()])
+    [key] = fake_s3.objects
+    fake_s3.objects[key] = b"{not json"
+
+    [result] = mirth.process_segment_group([pid_segment()])
+
+    assert len(claude.calls) == 2
+    assert result["fields"][0]["Canonical Field JS Code"] == "tmp['PID']['PID.5']['PID.5.1'];"
+
+
+def test_process_segment_group_ignores_cache_write_errors(fake_s3, claude):
+    fake_s3.put_error = "AccessDenied"
+    claude.responses.append(pid5_block())
+
+    [result] = mirth.process_segment_group([pid_segment()])
+
+    assert result["fields"][0]["Canonical Field JS Code"] == "tmp['PID']['PID.5']['PID.5.1'];"
+
+
+def test_cache_key_uses_model_that_answered(fake_s3, claude):
+    claude.model_id = mirth.FALLBACK_MODEL_ID
+    claude.responses.append(pid5_block())
+
+    mirth.process_segment_group([pid_segment()])
+
+    llm_fields = [pid_segment()["fields"][0]]
+    fallback_key = mirth.get_cache_key("PID", llm_fields, mirth.FALLBACK_MODEL_ID)
+    assert list(fake_s3.objects) == [f"{mirth.CACHE_PREFIX}{fallback_key}.json"]
+
+    # Lookups also check the fallback model's key when the primary model has no entry
+    mirth.process_segment_group([pid_segment()])
+    assert len(claude.calls) == 1
+
+
+def test_cache_key_ignores_per_run_field_stats():
+    field = {"Canonical Field": "PID-5", "Source Field": "PID-5", "Transformation Rules": "Copy legal name"}
+    rerun_field = {
+        **field,
+        "Fill Rate": "87.5",
+        "Min Length": "3",
+        "Max Length": "40",
+        "Sample Input Values": "Smith^Jane, Doe^John",
+        "Expected Output": "Jane",
+        "Canonical Field JS Code": "tmp['PID']['PID.5']['PID.5.1']"
+    }
+
+    assert mirth.get_cache_key("PID", [field], mirth.MODEL_ID) == mirth.get_cache_key("PID", [rerun_field], mirth.MODEL_ID)
+
+
+@pytest.mark.parametrize("change", [
+    {"Source Field": "PID-6"},
+    {"Transformation Rules": "Copy maiden name"},
+    {"Canonical Field": "PID-6"}
+])
+def test_cache_key_changes_with_prompt_inputs(change):
+    field = {"Canonical Field": "PID-5", "Source Field": "PID-5", "Transformation Rules": "Copy legal name"}
+
+    assert mirth.get_cache_key("PID", [field], mirth.MODEL_ID) != mirth.get_cache_key("PID", [{**field, **change}], mirth.MODEL_ID)
+
+
+def test_cache_key_changes_with_segment_model_and_prompt(monkeypatch):
+    fields = pid_segment()["fields"]
+    key = mirth.get_cache_key("PID", fields, mirth.MODEL_ID)
+
+    assert mirth.get_cache_key("PD1", fields, mirth.MODEL_ID) != key
+    assert mirth.get_cache_key("PID", fields, mirth.FALLBACK_MODEL_ID) != key
+    monkeypatch.setattr(mirth, "PROMPT_VERSION", "edited")
+    assert mirth.get_cache_key("PID", fields, mirth.MODEL_ID) != key
+
+
+def test_process_segment_group_hits_cache_when_only_stats_change(fake_s3, claude):
+    claude.responses.append(pid5_block())
+    mirth.process_segment_group([pid_segment()])
+
+    segment = pid_segment()
+    for field in segment["fields"]:
+        field["Fill Rate"] = "42.0"
+        field["Sample Input Values"] = "different, values"
+    mirth.process_segment_group([segment])
+
+    assert len(claude.calls) == 1
+
+
+def test_full_pack_fits_output_budget():
+    assert mirth.OUTPUT_TOKENS_PER_FIELD * mirth.MAX_FIELDS_PER_CALL + mirth.OUTPUT_TOKENS_BASE <= mirth.MAX_OUTPUT_TOKENS
+
+
+class FakeBedrock:
+    """Streams a canned response, rejecting requests for the given (model_id, latency) pairs with their message."""
+
+    class exceptions:
+        class ValidationException(ClientError):
+            pass
+
+    def __init__(self, rejected):
+        self.rejected = rejected
+        self.requests = []
+
+    def invoke_model_with_response_stream(self, **payload):
+        self.requests.append(payload)
+        message = self.rejected.get((payload["modelId"], payload["performanceConfigLatency"]))
+        if message:
+            error = {"Error": {"Code": "ValidationException", "Message": message}}
+            raise self.exceptions.ValidationException(error, "InvokeModelWithResponseStream")
+        events = [
+            {"type": "content_block_delta", "delta": {"text": "ok"}},
+            {"type": "message_delta", "delta": {"stop_reason": "end_turn"}}
+        ]
+        return {"body": [{"chunk": {"bytes": json.dumps(event).encode("utf-8")}} for event in events]}
+
+
+LATENCY_UNSUPPORTED = "The model does not support latency optimized inference in this region."
+MODEL_UNSUPPORTED = "Invocation of model ID with on-demand throughput isn't supported."
+
+
+@pytest.fixture
+def optimized_variants(monkeypatch):
+    variants = [
+        (mirth.MODEL_ID, "optimized", True),
+        (mirth.MODEL_ID, "standard", True),
+        (mirth.FALLBACK_MODEL_ID, "standard", False)
+    ]
+    monkeypatch.setattr(mirth, "REQUEST_VARIANTS", variants)
+
+
+def test_default_request_uses_standard_latency_with_prompt_caching(monkeypatch):
+    fake = FakeBedrock(rejected={})
+    monkeypatch.setattr(mirth, "bedrock", fake)
+
+    assert mirth.call_claude("prompt") == ("ok", mirth.MODEL_ID, "end_turn")
+
+    [request] = fake.requests
+    assert request["performanceConfigLatency"] == "standard"
+    assert "cache_control" in json.loads(request["body"])["system"][0]
+
+
+def test_rejected_latency_retries_primary_model_before_fallback(monkeypatch, optimized_variants):
+    fake = FakeBedrock(rejected={(mirth.MODEL_ID, "optimized"): LATENCY_UNSUPPORTED})
+    monkeypatch.setattr(mirth, "bedrock", fake)
+
+    assert mirth.call_claude("prompt") == ("ok", mirth.MODEL_ID, "end_turn")
+
+    assert [(r["modelId"], r["performanceConfigLatency"]) for r in fake.requests] == [
+        (mirth.MODEL_ID, "optimized"),
+        (mirth.MODEL_ID, "standard")
+    ]
+    assert "cache_control" in json.loads(fake.requests[1]["body"])["system"][0]
+
+
+def test_fallback_is_scoped_to_the_call(monkeypatch, optimized_variants):
+    fake = FakeBedrock(rejected={(mirth.MODEL_ID, "optimized"): LATENCY_UNSUPPORTED})
+    monkeypatch.setattr(mirth, "bedrock", fake)
+
+    mirth.call_claude("prompt")
+    fake.rejected = {}
+    mirth.call_claude("prompt")
+
+    assert fake.requests[-1]["performanceConfigLatency"] == "optimized"
+
+
+def test_rejected_primary_model_falls_back_without_prompt_caching(monkeypatch, optimized_variants):
+    fake = FakeBedrock(rejected={
+        (mirth.MODEL_ID, "optimized"): MODEL_UNSUPPORTED,
+        (mirth.MODEL_ID, "standard"): MODEL_UNSUPPORTED
+    })
+    monkeypatch.setattr(mirth, "bedrock", fake)
+
+    assert mirth.call_claude("prompt") == ("ok", mirth.FALLBACK_MODEL_ID, "end_turn")
+
+    assert [r["modelId"] for r in fake.requests] == [mirth.MODEL_ID, mirth.MODEL_ID, mirth.FALLBACK_MODEL_ID]
+    assert "cache_control" not in json.loads(fake.requests[-1]["body"])["system"][0]
+
+
+@pytest.mark.parametrize("message", [
+    "Input is too long for requested model.",
+    "max_tokens: range: 1..4096",
+    "messages: roles must alternate between \"user\" and \"assistant\""
+])
+def test_request_validation_errors_are_not_retried(monkeypatch, optimized_variants, message):
+    fake = FakeBedrock(rejected={(mirth.MODEL_ID, "optimized"): message})
+    monkeypatch.setattr(mirth, "bedrock", fake)
+
+    with pytest.raises(mirth.bedrock.exceptions.ValidationException):
+        mirth.call_claude("prompt")
+
+    assert len(fake.requests) == 1
+
+
+def rule_field(field_id):
+    return {"Canonical Field": field_id, "Source Field": field_id, "Transformation Rules": "Trim"}
+
+
+def rule_block(segment, field_id):
+    ref = mirth.get_canonical_js_code(field_id)
+    return claude_block(segment, field_id, f"{ref};", f"msg['{segment}'].toString().trim()", f"{ref} = msg['{segment}'].toString().trim();")
+
+
+def test_read_stream_text_returns_stop_reason():
+    events = [
+        {"type": "message_start", "message": {}},
+        {"type": "content_block_delta", "delta": {"text": "partial"}},
+        {"type": "message_delta", "delta": {"stop_reason": "max_tokens"}},
+        {"type": "message_stop"}
+    ]
+    response = {"body": [{"chunk": {"bytes": json.dumps(event).encode("utf-8")}} for event in events]}
+
+    assert mirth.read_stream_text(response) == ("partial", "max_tokens")
+
+
+def test_truncated_response_is_retried_with_full_budget(fake_s3, claude):
+    segment = {"segment": "PID", "fields": [rule_field("PID-5"), rule_field("PID-11")]}
+    claude.responses.extend([
+        (rule_block("PID", "PID-5"), "max_tokens"),
+        rule_block("PID", "PID-5") + rule_block("PID", "PID-11")
+    ])
+
+    [result] = mirth.process_segment_group([segment])
+
+    assert [call["max_tokens"] for call in claude.calls] == [mirth.output_token_budget(2), mirth.MAX_OUTPUT_TOKENS]
+    assert all(field["Canonical-Source Field JS Code"] for field in result["fields"])
+    assert len(fake_s3.objects) == 1
+
+
+def test_truncated_response_at_full_budget_is_split_in_half(fake_s3, claude):
+    segment = {"segment": "PID", "fields": [rule_field("PID-5"), rule_field("PID-11")]}
+    claude.responses.extend([
+        ("", "max_tokens"),
+        ("", "max_tokens"),
+        rule_block("PID", "PID-5"),
+        rule_block("PID", "PID-11")
+    ])
+
+    [result] = mirth.process_segment_group([segment])
+
+    assert "PID-11" not in claude.calls[2]["prompt"]
+    assert "PID-5" not in claude.calls[3]["prompt"]
+    assert all(field["Canonical-Source Field JS Code"] for field in result["fields"])
+    assert len(fake_s3.objects) == 1
+
+
+def test_single_field_truncated_at_full_budget_is_not_cached(fake_s3, claude):
+    segment = {"segment": "PID", "fields": [rule_field("PID-5")]}
+    claude.responses.extend([(rule_block("PID", "PID-5"), "max_tokens")] * 2)
+
+    [result] = mirth.process_segment_group([segment])
+
+    assert len(claude.calls) == 2
+    assert result["fields"][0]["Canonical-Source Field JS Code"]
+    assert fake_s3.objects == {}
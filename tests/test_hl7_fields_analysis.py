@@ -0,0 +1,152 @@
+import re
+import threading
+import time
+
+import pytest
+
+import hl7_fields_analysis as analysis
+
+
+@pytest.fixture
+def athena(monkeypatch):
+    """
+    Stub Athena: a query ends in the state mapped to the first column it references in `states`
+    (default SUCCEEDED), and returns stats per field when it succeeds.
+    """
+    queries = []
+    states = {}
+    timeouts = []
+    lock = threading.Lock()
+
+    def fake_run_athena_query(query):
+        with lock:
+            queries.append(query)
+            return len(queries) - 1
+
+    def fake_fetch_query_stats(query_execution_id, timeout=analysis.QUERY_TIMEOUT):
+        query = queries[query_execution_id]
+        timeouts.append(timeout)
+        fields = re.findall(r"'([^']+)' AS field_id", query)
+        for column, state in states.items():
+            if f'"{column}"' in query:
+                return state, None
+        return "SUCCEEDED", {field_id: {"filled_rows": "1"} for field_id in fields}
+
+    monkeypatch.setattr(analysis, "run_athena_query", fake_run_athena_query)
+    monkeypatch.setattr(analysis, "fetch_query_stats", fake_fetch_query_stats)
+    fake_run_athena_query.queries = queries
+    fake_run_athena_query.states = states
+    fake_run_athena_query.timeouts = timeouts
+    return fake_run_athena_query
+
+
+def test_build_segment_stats_query_guards_fill_rate_division():
+    query = analysis.build_segment_stats_query("PID", ["PID-5"])
+
+    assert "NULLIF(COUNT(*), 0)" in query
+    assert "/ COUNT(*)" not in query
+
+
+def test_collect_field_stats_runs_one_query_per_segment(athena):
+    stats = analysis.collect_field_stats({"PID": ["PID-3", "PID-5"], "PV1": ["PV1-2"]})
+
+    assert len(athena.queries) == 2
+    assert stats == {
+        "PID": {"PID-3": {"filled_rows": "1"}, "PID-5": {"filled_rows": "1"}},
+        "PV1": {"PV1-2": {"filled_rows": "1"}}
+    }
+
+
+def test_collect_field_stats_scales_timeout_with_field_count(athena):
+    analysis.collect_field_stats({"PID": ["PID-3", "PID-5", "PID-7"], "PV1": ["PV1-2"]})
+
+    assert athena.timeouts == [
+        analysis.QUERY_TIMEOUT + 2 * analysis.QUERY_TIMEOUT_PER_FIELD,
+        analysis.QUERY_TIMEOUT
+    ]
+
+
+def test_collect_field_stats_retries_failed_segment_per_field(athena):
+    athena.states["PID-99"] = "FAILED"
+
+    stats = analysis.collect_field_stats({"PID": ["PID-3", "PID-99", "PID-5"], "PV1": ["PV1-2"]})
+
+    # Two segment queries, then one query per PID field
+    assert len(athena.queries) == 5
+    assert stats["PID"] == {"PID-3": {"filled_rows": "1"}, "PID-5": {"filled_rows": "1"}}
+    assert stats["PV1"] == {"PV1-2": {"filled_rows": "1"}}
+
+
+def test_collect_field_stats_does_not_retry_timed_out_segment(athena):
+    athena.states["PID-3"] = "TIMED_OUT"
+
+    stats = analysis.collect_field_stats({"PID": ["PID-3", "PID-5"]})
+
+    assert len(athena.queries) == 1
+    assert stats == {"PID": {}}
+
+
+def test_collect_field_stats_does_not_retry_single_field_segment(athena):
+    athena.states["PV1-2"] = "FAILED"
+
+    stats = analysis.collect_field_stats({"PV1": ["PV1-2"]})
+
+    assert len(athena.queries) == 1
+    assert stats == {"PV1": {}}
+
+
+def test_run_field_queries_bounds_concurrency(monkeypatch):
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def fake_run_athena_query(query):
+        with lock:
+            running.append(query)
+            peak.append(len(running))
+        return query
+
+    def fake_fetch_query_stats(query_execution_id, timeout=analysis.QUERY_TIMEOUT):
+        time.sleep(0.01)
+        with lock:
+            running.remove(query_execution_id)
+        return "SUCCEEDED", {}
+
+    monkeypatch.setattr(analysis, "run_athena_query", fake_run_athena_query)
+    monkeypatch.setattr(analysis, "fetch_query_stats", fake_fetch_query_stats)
+
+    results = analysis.run_field_queries([f"query {i}" for i in range(12)])
+
+    assert len(results) == 12
+    assert max(peak) <= analysis.MAX_CONCURRENT_FALLBACK_QUERIES
+
+
+class FakeAthena:
+    def __init__(self, states):
+        self.states = list(states)
+        self.stopped = []
+
+    def get_query_execution(self, QueryExecutionId):
+        state = self.states.pop(0) if len(self.states) > 1 else self.states[0]
+        return {"QueryExecution": {"Status": {"State": state}}}
+
+    def stop_query_execution(self, QueryExecutionId):
+        self.stopped.append(QueryExecutionId)
+
+
+def test_await_query_stops_query_on_timeout(monkeypatch):
+    fake = FakeAthena(["RUNNING"])
+    monkeypatch.setattr(analysis, "athena", fake)
+    monkeypatch.setattr(analysis, "QUERY_POLL_INITIAL_DELAY", 0.01)
+
+    assert analysis.await_query("q-1", timeout=0.05) == ("TIMED_OUT", None)
+    assert fake.stopped == ["q-1"]
+
+
+def test_await_query_reports_failed_state_without_stopping(monkeypatch):
+    fake = FakeAthena(["RUNNING", "FAILED"])
+    monkeypatch.setattr(analysis, "athena", fake)
+    monkeypatch.setattr(analysis, "QUERY_POLL_INITIAL_DELAY", 0.01)
+
+    assert analysis.await_query("q-1", timeout=5) == ("FAILED", None)
+    assert fake.stopped == []
@@ -0,0 +1,72 @@
+import io
+from unittest import mock
+
+
+def fake_api_call(self, operation_name, kwargs):
+    # hl7v2_parser downloads its segment schema from S3 at import time
+    assert operation_name == "GetObject"
+    return {"Body": io.BytesIO(b'{"MSH": {}, "PID": {}, "PV1": {}}')}
+
+
+with mock.patch("botocore.client.BaseClient._make_api_call", fake_api_call):
+    import hl7v2_parser as parser
+
+
+def test_get_segments_accepts_cr_lf_and_crlf():
+    msg = "MSH|^~\\&|APP\rPID|1\nPV1|1\r\nOBX|1"
+
+    assert parser.getSegments(msg) == ["MSH|^~\\&|APP", "PID|1", "PV1|1", "OBX|1"]
+
+
+def test_get_segments_skips_blank_and_whitespace_only_lines():
+    msg = "MSH|^~\\&|APP\r \r\r\t\nPID|1\r"
+
+    assert parser.getSegments(msg) == ["MSH|^~\\&|APP", "PID|1"]
+
+
+def test_whitespace_only_line_does_not_create_empty_segment():
+    parsed = parser.hl7_to_custom_json("MSH|^~\\&|APP\r \rPID|1||123^^^HOSP^MR")
+
+    assert "" not in parsed
+    assert "PID" in parsed
+
+
+def test_convert_to_parquet_tables_pads_missing_columns_with_none():
+    messages = [
+        {"MSH": [{"10": "m1"}], "PID": [{"3": "123", "5": ["Doe", "John"]}, {"3": "456"}]},
+        {"MSH": [{"10": "m2"}], "PID": [{"8": "F"}], "ZZZ": [{"1": "ignored"}]}
+    ]
+
+    tables = parser.convert_to_parquet_tables(messages)
+
+    assert "ZZZ" not in tables
+    pid = tables["PID"]
+    assert pid["num_rows"] == 3
+    assert pid["columns"] == {
+        "message_control_id": ["m1", "m1", "m2"],
+        "PID-3": ["123", "456", None],
+        "PID-5": ['["Doe","John"]', None, None],
+        "PID-8": [None, None, "F"]
+    }
+    assert all(len(column) == table["num_rows"] for table in tables.values() for column in table["columns"].values())
+
+
+def test_convert_to_parquet_tables_matches_row_wise_table():
+    import pyarrow as pa
+
+    messages = [
+        parser.hl7_to_custom_json("MSH|^~\\&|APP|||||||m1\rPID|1||123||Doe^John\rPV1|1|I"),
+        parser.hl7_to_custom_json("MSH|^~\\&|APP|||||||m2\rPID|1|||||||F\rPID|2||789")
+    ]
+
+    tables = parser.convert_to_parquet_tables(messages)
+
+    rows = [
+        {"message_control_id": msg["MSH"][0]["10"], **{f"PID-{k}": parser.serialize_field(v) for k, v in entry.items()}}
+        for msg in messages for entry in msg["PID"]
+    ]
+    column_names = tables["PID"]["columns"].keys()
+    assert set(column_names) == {name for row in rows for name in row}
+    assert pa.table(tables["PID"]["columns"]).to_pylist() == [
+        {name: row.get(name) for name in column_names} for row in rows
+    ]
@@ -1,11 +1,28 @@
+import io
 import json
+import orjson
 import boto3
+from botocore.config import Config
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-bedrock = boto3.client("bedrock-runtime")
+# Upper bound on concurrent Bedrock validation calls per Lambda run
+MAX_CONCURRENT_SEGMENTS = 8
+
+# One pooled connection per validation worker, kept alive across warm invocations
+BOTO_CONFIG = Config(
+    max_pool_connections=MAX_CONCURRENT_SEGMENTS,
+    retries={"mode": "adaptive"},
+    tcp_keepalive=True
+)
+
+bedrock = boto3.client("bedrock-runtime", config=BOTO_CONFIG)
+
+# Decodes exactly one JSON value from an offset, ignoring any trailing commentary
+JSON_DECODER = json.JSONDecoder()
 
 def lambda_handler(event, context):
     logger.info(f"Received event: {json.dumps(event)[:1000]}")
@@ -13,25 +30,14 @@ def lambda_handler(event, context):
     js_specs = event.get("js_specs", [])
     logger.info(f"js_specs length: {len(js_specs)}")
     
-    validation_report = []
+    segment_prompts = []
 
     for i, segment_spec in enumerate(js_specs):
         logger.info(f"Processing segment {i+1}/{len(js_specs)}")
         
+        # Each entry is a flat {"segment", "fields"} result from generate_mirth_js_code
         segment_name = segment_spec.get("segment")
-        
-        if "js_result" in segment_spec:
-            js_result = segment_spec.get("js_result")
-            logger.info(f"Found js_result, type: {type(js_result)}")
-            
-            if isinstance(js_result, list) and len(js_result) > 0:
-                fields = js_result[0].get("fields", []) if isinstance(js_result[0], dict) else []
-            elif isinstance(js_result, dict):
-                fields = js_result.get("fields", [])
-            else:
-                fields = []
-        else:
-            fields = segment_spec.get("fields", [])
+        fields = segment_spec.get("fields", [])
         
         logger.info(f"Segment: {segment_name}, Found {len(fields)} fields")
         
@@ -41,41 +47,13 @@ def lambda_handler(event, context):
 
         prompt = build_prompt(segment_name, fields)
         logger.info(f"Built prompt for {segment_name}, length: {len(prompt)} chars")
-        
-        try:
-            logger.info(f"Calling Bedrock for segment {segment_name}")
-            
-            response = bedrock.invoke_model(
-                modelId="anthropic.claude-3-sonnet-20240229-v1:0",
-                contentType="application/json",
-                accept="application/json",
-                body=json.dumps({
-                    "anthropic_version": "bedrock-2023-05-31",    
-                    "messages": [{"role": "user", "content": prompt}],
-                    "max_tokens": 4000,
-                    "temperature": 0
-                })
-            )
-
-            response_body = json.loads(response["body"].read())
-            result_text = response_body["content"][0]["text"]
-            
-            logger.info(f"Received response from Claude for {segment_name}")
-            
-            parsed_fields = parse_response(result_text)
-            logger.info(f"Parsed {len(parsed_fields)} validation results for {segment_name}")
-            
-            validation_report.append({
-                "segment": segment_name,
-                "fields": parsed_fields
-            })
-            
-        except Exception as e:
-            logger.error(f"Error processing segment {segment_name}: {str(e)}", exc_info=True)
-            validation_report.append({
-                "segment": segment_name,
-                "error": str(e)
-            })
+        segment_prompts.append((segment_name, prompt))
+
+    validation_report = []
+    if segment_prompts:
+        # Bedrock calls are network-bound, so segments are validated concurrently (order preserved)
+        with ThreadPoolExecutor(max_workers=min(len(segment_prompts), MAX_CONCURRENT_SEGMENTS)) as executor:
+            validation_report = list(executor.map(lambda args: validate_segment(*args), segment_prompts))
 
     logger.info(f"Total validation report segments: {len(validation_report)}")
 
@@ -84,61 +62,103 @@ def lambda_handler(event, context):
         "body": json.dumps({"validation_report": validation_report}, indent=2)
     }
 
+def validate_segment(segment_name, prompt):
+    try:
+        logger.info(f"Calling Bedrock for segment {segment_name}")
+        
+        response = bedrock.invoke_model(
+            modelId="anthropic.claude-3-sonnet-20240229-v1:0",
+            contentType="application/json",
+            accept="application/json",
+            body=json.dumps({
+                "anthropic_version": "bedrock-2023-05-31",    
+                "messages": [{"role": "user", "content": prompt}],
+                "max_tokens": 4000,
+                "temperature": 0
+            })
+        )
+
+        response_body = orjson.loads(response["body"].read())
+        result_text = response_body["content"][0]["text"]
+        
+        logger.info(f"Received response from Claude for {segment_name}")
+        
+        parsed_fields = parse_response(result_text)
+        logger.info(f"Parsed {len(parsed_fields)} validation results for {segment_name}")
+        
+        return {
+            "segment": segment_name,
+            "fields": parsed_fields
+        }
+        
+    except Exception as e:
+        logger.error(f"Error processing segment {segment_name}: {str(e)}", exc_info=True)
+        return {
+            "segment": segment_name,
+            "error": str(e)
+        }
+
+# Static instructions that follow the segment-specific first line of every validation prompt
+PROMPT_HEADER = "\n".join([
+    "",
+    "**Input Structure:**",
+    "- Each field includes:",
+    "  - Field ID (e.g., PV1-3)",
+    "  - Label (field description)",
+    "  - Sample Values (actual HL7 data as nested arrays)",
+    "  - Statistics (fill rate, total rows, etc.)",
+    "  - Ruleset (transformation rule to apply, if specified)",
+    "",
+    "**Instructions:**",
+    "- WHEN a transformation rule exists:",
+    "  - Apply the rule to each sample value",
+    "  - Set 'Rule Triggered' to 'Yes'",
+    "  - Include the rule text in 'Transformation Rules'",
+    "  - Return ONLY the transformed values in 'Expected Output'",
+    "- WHEN no rule exists:",
+    "  - Set 'Rule Triggered' to 'No'",
+    "  - Return sample values as-is in 'Expected Output'",
+    "",
+    "**HL7 Structure Guidance:**",
+    "- Sample values may contain nested arrays representing HL7 components, sub-components, or repetitions",
+    "- Reconstruct HL7 strings using:",
+    "  - '^' to join components",
+    "  - '&' to join sub-components",
+    "  - '~' to join repetitions",
+    "- Example: ['GLU', 'Glucose', ['LN', 'GLU', '1234']] → 'GLU^Glucose^LN&GLU&1234'",
+    "- Example: [['ICU', '101'], ['ER', '01']] → 'ICU^101~ER^01'",
+    "",
+    "**Output Format (JSON only):**",
+    "Return a JSON array of objects, each representing one field:",
+    '[{',
+    '  "Data Element": "...",',
+    '  "Canonical Field": "...",',
+    '  "Source Field": "...",',
+    '  "Sample Input": [...],',
+    '  "Expected Output": [...],',
+    '  "Actual Output": [...],',
+    '  "Validation Status": "Pass or Fail",',
+    '  "Validation Comments": "Details if failed, e.g., \'[1] expected ER^01^01, got ER\'",',
+    '  "Transformation Rules": "...",',
+    '  "Source Field JS Code": "..."',
+    '}]',
+    "",
+    "**Critical Instructions:**",
+    "- ONE row per field",
+    "- Sample Input, Expected Output, and Actual Output must be arrays",
+    "- Escape special characters properly",
+    "- Return ONLY valid JSON — no markdown, no commentary",
+    "",
+    "**Fields to Validate:**",
+    ""
+])
+
 def build_prompt(segment_name, fields):
-    lines = [
-        f"You are an HL7 transformation assistant. Your task is to evaluate HL7 field values from the {segment_name} segment against transformation rules and produce a clean, structured JSON response.",
-        "",
-        "**Input Structure:**",
-        "- Each field includes:",
-        "  - Field ID (e.g., PV1-3)",
-        "  - Label (field description)",
-        "  - Sample Values (actual HL7 data as nested arrays)",
-        "  - Statistics (fill rate, total rows, etc.)",
-        "  - Ruleset (transformation rule to apply, if specified)",
-        "",
-        "**Instructions:**",
-        "- WHEN a transformation rule exists:",
-        "  - Apply the rule to each sample value",
-        "  - Set 'Rule Triggered' to 'Yes'",
-        "  - Include the rule text in 'Transformation Rules'",
-        "  - Return ONLY the transformed values in 'Expected Output'",
-        "- WHEN no rule exists:",
-        "  - Set 'Rule Triggered' to 'No'",
-        "  - Return sample values as-is in 'Expected Output'",
-        "",
-        "**HL7 Structure Guidance:**",
-        "- Sample values may contain nested arrays representing HL7 components, sub-components, or repetitions",
-        "- Reconstruct HL7 strings using:",
-        "  - '^' to join components",
-        "  - '&' to join sub-components",
-        "  - '~' to join repetitions",
-        "- Example: ['GLU', 'Glucose', ['LN', 'GLU', '1234']] → 'GLU^Glucose^LN&GLU&1234'",
-        "- Example: [['ICU', '101'], ['ER', '01']] → 'ICU^101~ER^01'",
-        "",
-        "**Output Format (JSON only):**",
-        "Return a JSON array of objects, each representing one field:",
-        '[{',
-        '  "Data Element": "...",',
-        '  "Canonical Field": "...",',
-        '  "Source Field": "...",',
-        '  "Sample Input": [...],',
-        '  "Expected Output": [...],',
-        '  "Actual Output": [...],',
-        '  "Validation Status": "Pass or Fail",',
-        '  "Validation Comments": "Details if failed, e.g., \'[1] expected ER^01^01, got ER\'",',
-        '  "Transformation Rules": "...",',
-        '  "Source Field JS Code": "..."',
-        '}]',
-        "",
-        "**Critical Instructions:**",
-        "- ONE row per field",
-        "- Sample Input, Expected Output, and Actual Output must be arrays",
-        "- Escape special characters properly",
-        "- Return ONLY valid JSON — no markdown, no commentary",
-        "",
-        "**Fields to Validate:**",
-        ""
-    ]
+    buf = io.StringIO()
+    w = buf.write
+    w(f"You are an HL7 transformation assistant. Your task is to evaluate HL7 field values from the {segment_name} segment against transformation rules and produce a clean, structured JSON response.")
+    w("\n")
+    w(PROMPT_HEADER)
     
     fields_added = 0
     for field in fields:
@@ -154,42 +174,41 @@ def build_prompt(segment_name, fields):
         sample_inputs = field.get('Sample Input Values')
         expected_outputs = field.get('Expected Output')
         
-        lines.append("---")
-        lines.append(f"Data Element: {field.get('Data Element')}")
-        lines.append(f"Canonical Field: {field.get('Canonical Field')}")
-        lines.append(f"Source Field: {field.get('Source Field')}")
-        lines.append(f"Sample Input Values: {json.dumps(sample_inputs)}")
-        lines.append(f"Expected Output: {json.dumps(expected_outputs)}")
-        lines.append(f"Transformation Rules: {trans_rules_str}")
-        lines.append(f"Source Field JS Code: {field.get('Source Field JS Code')}")
-        lines.append("")
+        w("\n---")
+        w(f"\nData Element: {field.get('Data Element')}")
+        w(f"\nCanonical Field: {field.get('Canonical Field')}")
+        w(f"\nSource Field: {field.get('Source Field')}")
+        w(f"\nSample Input Values: {orjson.dumps(sample_inputs).decode('utf-8')}")
+        w(f"\nExpected Output: {orjson.dumps(expected_outputs).decode('utf-8')}")
+        w(f"\nTransformation Rules: {trans_rules_str}")
+        w(f"\nSource Field JS Code: {field.get('Source Field JS Code')}")
+        w("\n")
         fields_added += 1
     
     logger.info(f"Added {fields_added} fields to prompt for {segment_name}")
     
-    lines.append("---")
-    lines.append("Return ONLY the JSON array with one object per field.")
+    w("\n---")
+    w("\nReturn ONLY the JSON array with one object per field.")
     
-    return "\n".join(lines)
+    return buf.getvalue()
 
 def parse_response(text):
     try:
         cleaned = text.strip()
         
         if "```" in cleaned:
-            start = cleaned.find("```") + 3
-            if cleaned[start:start+4] == "json":
-                start += 4
-            end = cleaned.find("```", start)
-            cleaned = cleaned[start:end].strip()
-        
-        if not cleaned.startswith('['):
-            start = cleaned.find('[')
-            end = cleaned.rfind(']')
-            if start != -1 and end != -1:
-                cleaned = cleaned[start:end+1]
+            _, _, after = cleaned.partition("```")
+            if after.startswith("json"):
+                after = after[4:]
+            # An unterminated fence keeps everything after the opening marker
+            cleaned, _, _ = after.partition("```")
+            cleaned = cleaned.strip()
         
-        parsed = json.loads(cleaned)
+        start = cleaned.find('[')
+        if start != -1:
+            parsed, _ = JSON_DECODER.raw_decode(cleaned, start)
+        else:
+            parsed = orjson.loads(cleaned)
         for item in parsed:
             if not all(k in item for k in ["Canonical Field", "Expected Output", "Actual Output"]):
                 logger.warning(f"Incomplete field data: {item}")